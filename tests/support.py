@@ -0,0 +1,79 @@
+'''Shared fixtures for tests that need a local HTTP server, built on the stand-in server from xcodetools_bench.py.'''
+
+import hashlib  # NOQA
+import os  # NOQA
+import shutil  # NOQA
+import sys  # NOQA
+import tempfile  # NOQA
+import threading  # NOQA
+import unittest  # NOQA
+
+import xcodetools  # NOQA
+import xcodetools_bench  # NOQA
+
+from StringIO import StringIO  # NOQA
+
+
+def payload(name, size):
+    '''Returns size bytes of data that differ for every name, so each file has its own digest.'''
+    block = ''.join(hashlib.sha256('{}-{}'.format(name, count)).digest() for count in range(2048))
+    return (block * (size // len(block) + 1))[:size]
+
+
+def runMain(*args):
+    '''Runs xcodetools.main() with args on the command line, returning its exit status, stdout and stderr.'''
+    argv, stdout, stderr = sys.argv, sys.stdout, sys.stderr
+    sys.argv, sys.stdout, sys.stderr = ['xcodetools.py'] + list(args), StringIO(), StringIO()
+    try:
+        try:
+            xcodetools.main()
+            status = 0
+        except SystemExit as e:
+            status = e.code
+        return status, sys.stdout.getvalue(), sys.stderr.getvalue()
+    finally:
+        sys.argv, sys.stdout, sys.stderr = argv, stdout, stderr
+
+
+class ServerTestCase(unittest.TestCase):
+    '''Serves files written with writeSiteFile() from a temporary folder, and records the headers of every request made with openURL().'''
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='xcodetools_test.')
+        self.site_dir = os.path.join(self.temp_dir, 'site')
+        os.makedirs(self.site_dir)
+        self.server = xcodetools_bench.BenchServer(('127.0.0.1', 0), self.site_dir)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.base_url = 'http://{}:{}'.format(*self.server.server_address)
+        self.transport = xcodetools.HTTPTransport()
+        self.metrics = xcodetools.Metrics()
+        self.requests = []
+        self.requests_lock = threading.Lock()
+
+    def tearDown(self):
+        # Pooled connections are closed so the server isn't left waiting on them
+        for idle in self.transport.pools.values():
+            for connection in idle:
+                connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def writeSiteFile(self, path, data):
+        '''Writes a file for the server to serve at path, and returns its URL.'''
+        site_path = os.path.join(self.site_dir, path.lstrip('/'))
+        if not os.path.isdir(os.path.dirname(site_path)):
+            os.makedirs(os.path.dirname(site_path))
+        with open(site_path, 'wb') as site_file:
+            site_file.write(data)
+        return self.base_url + path
+
+    def openURL(self, url, headers=None, timeout=None):
+        with self.requests_lock:
+            self.requests.append(list(headers or []))
+        return self.transport.open(url, headers=headers, timeout=timeout)
+
+    def rangeStarts(self):
+        '''Returns the start of each byte range requested, other than the one byte request made to find the size, in order.'''
+        return sorted(int(header.split('=')[1].split('-')[0]) for headers in self.requests for header in headers if header.startswith('Range:') and header != 'Range: bytes=0-0')
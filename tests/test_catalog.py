@@ -0,0 +1,94 @@
+'''Tests for processing a catalog served from a synthetic site.'''
+
+import os  # NOQA
+import re  # NOQA
+import time  # NOQA
+import unittest  # NOQA
+
+import xcodetools  # NOQA
+import xcodetools_bench  # NOQA
+
+from tests.support import ServerTestCase, runMain  # NOQA
+
+
+class ProcessSUCatalogTest(ServerTestCase):
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        # 8 products with CLTools packages, numbered 0 to 35. Each has the same packages, the higher the number the newer the version.
+        xcodetools_bench.generateSite(self.site_dir, ['10.14'], products=40, packages=3, matching=8, payload_size=1024)
+
+    def newXcodeCLI(self, name, **kwargs):
+        kwargs.setdefault('no_cache', True)
+        return xcodetools.XcodeCLI(base_url=self.base_url, cache_dir=os.path.join(self.temp_dir, name, 'cache'), destination=os.path.join(self.temp_dir, name, 'dest'),
+                                   mac_os_ver='10.14', quiet=True, transport=self.transport, **kwargs)
+
+    def processSUCatalog(self, name, delay=None, **kwargs):
+        '''Returns packages_to_process after processing the catalog, delaying each metadata fetch by delay(product number) seconds.'''
+        xcode = self.newXcodeCLI(name, **kwargs)
+        if delay:
+            fetch = xcode.fetchMetadataFile
+
+            def delayed(url):
+                time.sleep(delay(int(re.search(r'091-(\d+)', url).group(1))))
+                return fetch(url)
+            xcode.fetchMetadataFile = delayed
+        xcode.processSUCatalog()
+        return xcode.packages_to_process
+
+    def testNewestVersionSelected(self):
+        packages = self.processSUCatalog('newest')
+        self.assertEqual(sorted(packages), ['CLTools_Executables.pkg', 'CLTools_SDK_macOS1014.pkg', 'RemoveCLTools_OldSDK.pkg'])
+        for package in packages.values():
+            self.assertEqual(package['product_id'], '091-00035')
+            self.assertEqual(package['long_version'], '10.2.0.0.1.1500000035')
+
+    def testOrderIndependent(self):
+        '''The packages chosen don't depend on the order metadata fetches finish in.'''
+        sequential = self.processSUCatalog('sequential', max_workers=1)
+        newest_last = self.processSUCatalog('newest_last', delay=lambda number: number * 0.002, max_workers=8)
+        newest_first = self.processSUCatalog('newest_first', delay=lambda number: (35 - number) * 0.002, max_workers=8)
+
+        def selected(packages):
+            return dict((pkg, (package['product_id'], package['long_version'], package['url'])) for pkg, package in packages.items())
+        self.assertEqual(selected(newest_last), selected(sequential))
+        self.assertEqual(selected(newest_first), selected(sequential))
+
+    def testNotModified(self):
+        '''A catalog the server says hasn't changed isn't fetched or parsed again, the cached candidates are used instead.'''
+        first = self.newXcodeCLI('cached', no_cache=False)
+        first.processSUCatalog()
+
+        second = self.newXcodeCLI('cached', no_cache=False)
+
+        def parse(sucatalog_file):
+            raise AssertionError('unchanged catalog parsed again')
+        second.iterSUCatalogProducts = parse
+        second.processSUCatalog()
+        self.assertEqual(second.metrics.counters.get('catalog_not_modified'), 1)
+        self.assertEqual(second.packages_to_process, first.packages_to_process)
+
+        # Once the catalog changes it is fetched and parsed again
+        for folder, _, names in os.walk(self.site_dir):
+            for name in names:
+                if '.sucatalog' in name:
+                    os.utime(os.path.join(folder, name), (time.time() + 10, time.time() + 10))
+        third = self.newXcodeCLI('cached', no_cache=False)
+        third.processSUCatalog()
+        self.assertNotIn('catalog_not_modified', third.metrics.counters)
+        self.assertEqual(third.packages_to_process, first.packages_to_process)
+
+    def testChangesOnlyQuiet(self):
+        '''With -q, --changes-only prints the changes and nothing else.'''
+        args = ['--base-url', self.base_url, '--mac-os-ver', '10.14', '--cache-dir', os.path.join(self.temp_dir, 'changes', 'cache'), '--changes-only', '-q']
+        status, output, _ = runMain(*args)
+        self.assertEqual(status, 0)
+        lines = output.splitlines()
+        self.assertEqual(lines[0], 'macOS 10.14: 8 new, 0 changed, 0 removed product(s)')
+        self.assertEqual(len(lines), 9)
+        self.assertTrue(all(line.startswith('    new 091-') for line in lines[1:]))
+
+        self.assertEqual(runMain(*args), (0, 'macOS 10.14: no changes since last run\n', ''))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+'''Tests for SegmentedDownload against a local server.'''
+
+import hashlib  # NOQA
+import os  # NOQA
+import plistlib  # NOQA
+import time  # NOQA
+import unittest  # NOQA
+
+import xcodetools  # NOQA
+
+from tests.support import ServerTestCase, payload  # NOQA
+
+segment_size = 65536
+
+
+class DownloadTestCase(ServerTestCase):
+    '''Downloads a file of a few segments from the local server to the destination folder.'''
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.data = payload('CLTools_Executables', segment_size * 4 + 1000)
+        self.url = self.writeSiteFile('/downloads/CLTools_Executables.pkg', self.data)
+        self.output_file = os.path.join(self.temp_dir, 'dest', 'CLTools_Executables.pkg')
+
+    def download(self, open_url=None, data=None, connections=2):
+        data = data or self.data
+        return xcodetools.SegmentedDownload(self.url, self.output_file, open_url or self.openURL, size=len(data), digest=hashlib.sha1(data).hexdigest(),
+                                            connections=connections, segment_size=segment_size, metrics=self.metrics)
+
+    def failFrom(self, offset):
+        '''Returns an open_url that fails every range request starting at or after offset.'''
+        def open_url(url, headers=None, timeout=None):
+            for header in headers or []:
+                if header.startswith('Range:') and int(header.split('=')[1].split('-')[0]) >= offset:
+                    raise IOError('Connection reset')
+            return self.openURL(url, headers=headers, timeout=timeout)
+        return open_url
+
+    def readOutput(self):
+        with open(self.output_file, 'rb') as output_file:
+            return output_file.read()
+
+
+class SegmentedDownloadTest(DownloadTestCase):
+    def testDownload(self):
+        self.download().run()
+        self.assertEqual(self.readOutput(), self.data)
+        self.assertEqual(self.rangeStarts(), range(0, len(self.data), segment_size))
+        self.assertFalse(os.path.exists('{}.part'.format(self.output_file)))
+        self.assertFalse(os.path.exists('{}.part.plist'.format(self.output_file)))
+
+    def testResume(self):
+        '''An interrupted download keeps the segments it finished, and the next one only fetches the rest.'''
+        self.assertRaises(IOError, self.download(open_url=self.failFrom(segment_size * 3), connections=1).run)
+        self.assertFalse(os.path.exists(self.output_file))
+        state = plistlib.readPlist('{}.part.plist'.format(self.output_file))
+        self.assertEqual(sorted(state['completed']), [0, segment_size, segment_size * 2])
+
+        self.requests = []
+        self.download().run()
+        self.assertEqual(self.readOutput(), self.data)
+        self.assertEqual(self.rangeStarts(), [segment_size * 3, segment_size * 4])
+        self.assertFalse(os.path.exists('{}.part.plist'.format(self.output_file)))
+
+    def testResumeAfterFileChanged(self):
+        '''A partial download of a file that has changed on the server since is started again from scratch.'''
+        self.assertRaises(IOError, self.download(open_url=self.failFrom(segment_size * 3), connections=1).run)
+
+        changed = payload('CLTools_Executables changed', len(self.data))
+        self.writeSiteFile('/downloads/CLTools_Executables.pkg', changed)
+        site_file = os.path.join(self.site_dir, 'downloads', 'CLTools_Executables.pkg')
+        os.utime(site_file, (time.time() + 10, time.time() + 10))
+
+        self.requests = []
+        self.download(data=changed).run()
+        self.assertEqual(self.readOutput(), changed)
+        self.assertEqual(self.rangeStarts(), range(0, len(changed), segment_size))
+
+    def testServerWithoutRanges(self):
+        '''A server that ignores the range request sends the whole file, which is the download.'''
+        def open_url(url, headers=None, timeout=None):
+            return self.openURL(url, headers=[header for header in headers or [] if not header.startswith('Range:')], timeout=timeout)
+        self.download(open_url=open_url).run()
+        self.assertEqual(self.readOutput(), self.data)
+        self.assertEqual(len(self.requests), 1)
+
+
+class CorruptResponse():
+    '''Response that flips a bit in every byte read, as if the data was damaged on the way.'''
+    def __init__(self, response):
+        self.response = response
+        self.status = response.status
+        self.headers = response.headers
+
+    def read(self, size=-1):
+        return ''.join(chr(ord(byte) ^ 1) for byte in self.response.read(size))
+
+    def close(self):
+        self.response.close()
+
+
+class VerifyTest(DownloadTestCase):
+    def corruptFirstSegment(self, times):
+        '''Returns an open_url that damages the first segment the first times times it is fetched.'''
+        corrupted = []
+
+        def open_url(url, headers=None, timeout=None):
+            response = self.openURL(url, headers=headers, timeout=timeout)
+            if 'Range: bytes=0-{}'.format(segment_size - 1) in (headers or []) and len(corrupted) < times:
+                corrupted.append(url)
+                return CorruptResponse(response)
+            return response
+        return open_url
+
+    def testDigestMismatchRefetches(self):
+        '''A download that doesn't match the digest is thrown away and fetched once more.'''
+        self.download(open_url=self.corruptFirstSegment(1)).run()
+        self.assertEqual(self.readOutput(), self.data)
+        self.assertEqual(self.metrics.report()['counters'].get('download_refetches'), 1)
+        self.assertEqual(self.rangeStarts(), sorted(range(0, len(self.data), segment_size) * 2))
+
+    def testDigestMismatchGivesUp(self):
+        '''A download that still doesn't match after fetching it again fails, leaving nothing behind.'''
+        self.assertRaises(IOError, self.download(open_url=self.corruptFirstSegment(2)).run)
+        self.assertFalse(os.path.exists(self.output_file))
+        self.assertFalse(os.path.exists('{}.part'.format(self.output_file)))
+
+    def testVerifiedFileSkipped(self):
+        '''A file recorded as verified isn't requested or read again.'''
+        self.download().run()
+        self.requests = []
+        self.download(open_url=self.failFrom(0)).run()
+        self.assertEqual(self.requests, [])
+
+    def testTruncatedFileRefetched(self):
+        self.download().run()
+        with open(self.output_file, 'r+b') as output_file:
+            output_file.truncate(segment_size)
+        self.requests = []
+        self.download().run()
+        self.assertEqual(self.readOutput(), self.data)
+        self.assertEqual(self.rangeStarts(), range(0, len(self.data), segment_size))
+
+    def testModifiedFileRefetched(self):
+        '''A file changed since it was verified is checked again, and fetched again as it no longer matches.'''
+        self.download().run()
+        with open(self.output_file, 'r+b') as output_file:
+            output_file.write('damaged')
+        os.utime(self.output_file, (time.time() + 10, time.time() + 10))
+        self.requests = []
+        self.download().run()
+        self.assertEqual(self.readOutput(), self.data)
+        self.assertEqual(self.rangeStarts(), range(0, len(self.data), segment_size))
+
+    def testWrongSize(self):
+        '''A file on the server that isn't the size the catalog gives isn't downloaded.'''
+        self.assertRaises(IOError, self.download(data=self.data + 'extra').run)
+        self.assertFalse(os.path.exists(self.output_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
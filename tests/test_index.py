@@ -0,0 +1,104 @@
+'''Tests for the catalog index, and the list, search and show commands that answer from it.'''
+
+import os  # NOQA
+import shutil  # NOQA
+import tempfile  # NOQA
+import unittest  # NOQA
+
+import xcodetools  # NOQA
+import xcodetools_bench  # NOQA
+
+from tests.support import ServerTestCase, runMain  # NOQA
+
+
+class CatalogIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='xcodetools_test.')
+        self.cwd = os.getcwd()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def testBareFileName(self):
+        '''An index file given without a folder is created in the current one.'''
+        os.chdir(self.temp_dir)
+        index = xcodetools.CatalogIndex('index.sqlite')
+        index.update('http://example.com/index.sucatalog', '10.14', [])
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir, 'index.sqlite')))
+        self.assertEqual(index.query(), [])
+
+    def testUpdate(self):
+        '''Removed packages leave the index, and packages with a new PostDate lose their metadata until it is resolved again.'''
+        index = xcodetools.CatalogIndex(os.path.join(self.temp_dir, 'index', 'index.sqlite'))
+        catalog_url = 'http://example.com/index.sucatalog'
+        candidates = [{'product_id': '091-0000{}'.format(number), 'post_date': '2018-01-0{} 00:00:00'.format(number + 1), 'url': 'http://example.com/{}/CLTools_Executables.pkg'.format(number),
+                       'size': 1024, 'digest': None, 'smd_url': 'http://example.com/{}.smd'.format(number), 'pkm_url': 'http://example.com/{}.pkm'.format(number)} for number in range(3)]
+        index.update(catalog_url, '10.14', candidates)
+        index.setMetadata(catalog_url, candidates, [{'pkg_title': 'Command Line Tools', 'pkg_version': '10.{}'.format(number), 'long_pkg_version': '10.{}.0.0.1'.format(number),
+                                                     'pkg_identifier': 'com.apple.pkg.CLTools_Executables'} for number in range(3)])
+        self.assertEqual([(row['product_id'], row['long_version']) for row in index.query()], [('091-00002', '10.2.0.0.1'), ('091-00001', '10.1.0.0.1'), ('091-00000', '10.0.0.0.1')])
+
+        candidates[1]['post_date'] = '2018-01-05 00:00:00'
+        index.update(catalog_url, '10.14', candidates[1:])
+        self.assertEqual([(row['product_id'], row['long_version']) for row in index.query()], [('091-00001', None), ('091-00002', '10.2.0.0.1')])
+
+
+class QueryTest(ServerTestCase):
+    '''list, search and show, answered from the index filled in by a download of two releases.'''
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        # 4 products with CLTools packages, 091-00000, 05, 10 and 15, in both releases
+        xcodetools_bench.generateSite(self.site_dir, ['10.13', '10.14'], products=20, packages=3, matching=4, payload_size=1024)
+        self.cache_dir = os.path.join(self.temp_dir, 'cache')
+
+    def download(self):
+        self.assertEqual(runMain('--base-url', self.base_url, '--mac-os-ver', '10.13', '10.14', '--cache-dir', self.cache_dir, '-d', os.path.join(self.temp_dir, 'dest'), '-q'), (0, '', ''))
+
+    def query(self, *args):
+        '''Returns the exit status and output lines of a query.'''
+        status, output, _ = runMain(*(args + ('--cache-dir', self.cache_dir)))
+        return status, output.splitlines()
+
+    def testNoIndex(self):
+        status, lines = self.query('list')
+        self.assertEqual(status, 1)
+        self.assertIn('doesn\'t exist yet', lines[0])
+
+    def testList(self):
+        self.download()
+        status, lines = self.query('list')
+        self.assertEqual(status, 0)
+        self.assertEqual([line.split()[:2] for line in lines], [[mac_os_ver, '091-000{:02}'.format(number)] for number in [15, 10, 5, 0] for mac_os_ver in ['10.13', '10.14']])
+        self.assertIn('Command Line Tools (macOS) version 10.15', lines[0])
+        self.assertTrue(lines[0].endswith('CLTools_Executables.pkg, CLTools_SDK_macOS1014.pkg, RemoveCLTools_OldSDK.pkg'))
+
+        status, lines = self.query('list', '--mac-os-ver', '10.13')
+        self.assertEqual([line.split()[:2] for line in lines], [['10.13', '091-000{:02}'.format(number)] for number in [15, 10, 5, 0]])
+
+    def testSearch(self):
+        self.download()
+        status, lines = self.query('search', 'SDK_macOS1014')
+        self.assertEqual(status, 0)
+        self.assertEqual(len(lines), 8)
+        self.assertEqual(lines[0].split(), ['10.13', '091-00015', '2018-01-16', '15:00:00', 'CLTools_SDK_macOS1014.pkg', '10.2.0.0.1.1500000015', '1024'])
+
+        # By version, with the LIKE wildcards taken literally
+        status, lines = self.query('search', '1500000005', '--mac-os-ver', '10.14')
+        self.assertEqual(sorted(line.split()[4] for line in lines), ['CLTools_Executables.pkg', 'CLTools_SDK_macOS1014.pkg', 'RemoveCLTools_OldSDK.pkg'])
+        self.assertEqual(self.query('search', 'SDK_macOS1014%'), (1, ['Nothing in the catalog index matches']))
+        self.assertEqual(self.query('search', 'CLTools_SDK_macOS101_'), (1, ['Nothing in the catalog index matches']))
+
+    def testShow(self):
+        self.download()
+        status, lines = self.query('show', '091-00015')
+        self.assertEqual(status, 0)
+        self.assertEqual(lines[:3], ['091-00015 - Command Line Tools (macOS) version 10.15 (version 10.15) posted 2018-01-16 15:00:00', 'macOS releases: 10.13, 10.14', '    CLTools_Executables.pkg'])
+        # Each package once, with its URL, size, digest, identifier, version and metadata URL
+        self.assertEqual(len(lines), 2 + 3 * 7)
+        self.assertIn('        Identifier: com.apple.pkg.CLTools_SDK_macOS1014', lines)
+        self.assertEqual(self.query('show', '091-00001'), (1, ['Nothing in the catalog index matches']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+'''Tests for downloading and installing packages with a stand-in installer.'''
+
+import os  # NOQA
+import stat  # NOQA
+import threading  # NOQA
+import time  # NOQA
+import unittest  # NOQA
+
+import xcodetools  # NOQA
+import xcodetools_bench  # NOQA
+
+from tests.support import ServerTestCase  # NOQA
+
+installer_script = '''#!/bin/sh
+echo "$2" >> "$(dirname "$0")/installer.log"
+echo "installer: The install was successful."
+'''
+
+
+class PipelineInstallTest(ServerTestCase):
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        xcodetools_bench.generateSite(self.site_dir, ['10.14'], products=40, packages=3, matching=8, payload_size=1024)
+        self.installer = os.path.join(self.temp_dir, 'installer')
+        with open(self.installer, 'w') as installer_file:
+            installer_file.write(installer_script)
+        os.chmod(self.installer, stat.S_IRWXU)
+        os.makedirs(os.path.join(self.temp_dir, 'receipts'))
+
+    def install(self, delays):
+        '''Installs every package, each download taking delays[pkg] seconds longer. Returns the packages in the order they were installed,'''
+        '''and the most downloads that were running at once.'''
+        xcode = xcodetools.XcodeCLI(base_url=self.base_url, cache_dir=os.path.join(self.temp_dir, 'cache'), destination=os.path.join(self.temp_dir, 'dest'),
+                                    install=True, install_target='/', installer=self.installer, mac_os_ver='10.14', no_cache=True, quiet=True,
+                                    receipts_dir=os.path.join(self.temp_dir, 'receipts'), transport=self.transport)
+        xcode.scheduler.write = lambda message: None
+        active = {'now': 0, 'most': 0}
+        lock = threading.Lock()
+        download = xcode.downloadPkg
+
+        def delayed(package):
+            with lock:
+                active['now'] += 1
+                active['most'] = max(active['most'], active['now'])
+            time.sleep(delays[package['pkg']])
+            download(package)
+            with lock:
+                active['now'] -= 1
+        xcode.downloadPkg = delayed
+        xcode.mainProcessor()
+
+        with open(os.path.join(self.temp_dir, 'installer.log')) as log_file:
+            return [os.path.basename(line.strip()).split('_macOS_')[0] + '.pkg' for line in log_file], active['most']
+
+    def testInstallOrder(self):
+        '''Packages download concurrently, and are installed in priority order however their downloads finish.'''
+        installed, most = self.install({'RemoveCLTools_OldSDK.pkg': 0.5, 'CLTools_Executables.pkg': 0.2, 'CLTools_SDK_macOS1014.pkg': 0})
+        self.assertEqual(installed, ['RemoveCLTools_OldSDK.pkg', 'CLTools_Executables.pkg', 'CLTools_SDK_macOS1014.pkg'])
+        self.assertEqual(most, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
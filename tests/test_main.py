@@ -0,0 +1,27 @@
+'''Tests for the command line.'''
+
+import unittest  # NOQA
+
+from tests.support import runMain  # NOQA
+
+
+class MainTest(unittest.TestCase):
+    def testHelp(self):
+        for option in ['--help', '-h']:
+            status, output, _ = runMain(option)
+            self.assertEqual(status, 0)
+            self.assertIn('usage: xcodetools.py', output)
+            self.assertIn('{download,list,search,serve,show,watch}', output)
+            self.assertIn('--max-transfers <transfers>', output)
+
+    def testCountsBelowOne(self):
+        '''Transfer, connection and worker counts below 1 are refused rather than leaving the run waiting forever or failing later.'''
+        for option in ['--connections', '--max-transfers', '--max-workers']:
+            for value in ['-1', '0', 'x']:
+                status, _, error = runMain(option, value)
+                self.assertEqual(status, 2)
+                self.assertIn('argument {}: {} is not a whole number of 1 or more'.format(option, value), error)
+
+
+if __name__ == '__main__':
+    unittest.main()
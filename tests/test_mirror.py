@@ -0,0 +1,142 @@
+'''Tests for building a mirror from a local server, and serving it.'''
+
+import gzip  # NOQA
+import httplib  # NOQA
+import os  # NOQA
+import plistlib  # NOQA
+import threading  # NOQA
+import unittest  # NOQA
+
+import xcodetools  # NOQA
+import xcodetools_bench  # NOQA
+
+from tests.support import ServerTestCase, payload  # NOQA
+
+
+class MirrorTestCase(ServerTestCase):
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.mirror_dir = os.path.join(self.temp_dir, 'mirror')
+        os.makedirs(self.mirror_dir)
+        self.mirror = xcodetools.MirrorServer(('127.0.0.1', 0), self.mirror_dir, quiet=True)
+        mirror_thread = threading.Thread(target=self.mirror.serve_forever)
+        mirror_thread.daemon = True
+        mirror_thread.start()
+        self.mirror_url = 'http://{}:{}'.format(*self.mirror.server_address)
+
+    def tearDown(self):
+        self.mirror.shutdown()
+        self.mirror.server_close()
+        ServerTestCase.tearDown(self)
+
+
+class MirrorServerTest(MirrorTestCase):
+    def setUp(self):
+        MirrorTestCase.setUp(self)
+        self.data = payload('CLTools_Executables', 1000)
+        self.path = '/downloads/CLTools_Executables.pkg'
+        os.makedirs(os.path.join(self.mirror_dir, 'downloads'))
+        with open(os.path.join(self.mirror_dir, 'downloads', 'CLTools_Executables.pkg'), 'wb') as mirror_file:
+            mirror_file.write(self.data)
+
+    def request(self, path, headers=None, method='GET'):
+        '''Returns the status, headers and body of a request to the mirror.'''
+        connection = httplib.HTTPConnection(*self.mirror.server_address)
+        try:
+            connection.request(method, path, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        finally:
+            connection.close()
+
+    def testGet(self):
+        status, headers, body = self.request(self.path)
+        self.assertEqual(status, 200)
+        self.assertEqual(body, self.data)
+        self.assertEqual(headers['accept-ranges'], 'bytes')
+
+        status, headers, body = self.request(self.path, method='HEAD')
+        self.assertEqual((status, headers['content-length'], body), (200, '1000', ''))
+
+    def testRange(self):
+        status, headers, body = self.request(self.path, {'Range': 'bytes=100-199'})
+        self.assertEqual((status, headers['content-range'], body), (206, 'bytes 100-199/1000', self.data[100:200]))
+
+        # Open ended, suffix and overlong ranges
+        status, headers, body = self.request(self.path, {'Range': 'bytes=900-'})
+        self.assertEqual((status, headers['content-range'], body), (206, 'bytes 900-999/1000', self.data[900:]))
+        status, headers, body = self.request(self.path, {'Range': 'bytes=-10'})
+        self.assertEqual((status, headers['content-range'], body), (206, 'bytes 990-999/1000', self.data[990:]))
+        status, headers, body = self.request(self.path, {'Range': 'bytes=990-2000'})
+        self.assertEqual((status, headers['content-range'], body), (206, 'bytes 990-999/1000', self.data[990:]))
+
+    def testUnsatisfiableRange(self):
+        status, headers, body = self.request(self.path, {'Range': 'bytes=1000-'})
+        self.assertEqual((status, headers['content-range'], body), (416, 'bytes */1000', ''))
+
+    def testNotModified(self):
+        _, headers, _ = self.request(self.path)
+        status, _, body = self.request(self.path, {'If-None-Match': headers['etag']})
+        self.assertEqual((status, body), (304, ''))
+        status, _, body = self.request(self.path, {'If-Modified-Since': headers['last-modified']})
+        self.assertEqual((status, body), (304, ''))
+
+        # An ETag that doesn't match wins over a matching date
+        status, _, body = self.request(self.path, {'If-None-Match': '"other"', 'If-Modified-Since': headers['last-modified']})
+        self.assertEqual((status, body), (200, self.data))
+
+    def testHiddenFiles(self):
+        '''Partial downloads, their records and anything outside the mirror folder aren't served.'''
+        for name in ['CLTools_SDK.pkg.part', 'CLTools_SDK.pkg.part.plist', 'CLTools_SDK.pkg.verified']:
+            with open(os.path.join(self.mirror_dir, 'downloads', name), 'wb') as mirror_file:
+                mirror_file.write('partial')
+            self.assertEqual(self.request('/downloads/{}'.format(name))[0], 404)
+        self.assertEqual(self.request('/downloads/Missing.pkg')[0], 404)
+        self.assertEqual(self.request('/../{}'.format(os.path.basename(self.temp_dir)))[0], 404)
+
+
+class BuildMirrorTest(MirrorTestCase):
+    def setUp(self):
+        MirrorTestCase.setUp(self)
+        # 8 products with CLTools packages, numbered 0 to 35, the highest is the newest
+        xcodetools_bench.generateSite(self.site_dir, ['10.14'], products=40, packages=3, matching=8, payload_size=1024)
+
+    def newXcodeCLI(self, name, base_url):
+        return xcodetools.XcodeCLI(base_url=base_url, cache_dir=os.path.join(self.temp_dir, name, 'cache'), destination=os.path.join(self.temp_dir, name, 'dest'),
+                                   mac_os_ver='10.14', no_cache=True, quiet=True, transport=self.transport)
+
+    def testBuildMirror(self):
+        builder = xcodetools.XcodeCLIMirror(['10.14'], base_url=self.base_url, cache_dir=os.path.join(self.temp_dir, 'builder'), mirror_dir=self.mirror_dir,
+                                            mirror_url=self.mirror_url, no_cache=True, quiet=True, transport=self.transport)
+        builder.buildMirror()
+        member = builder.group.members[0]
+
+        # The rewritten catalog holds only the newest product, its URLs all pointing at the mirror
+        with gzip.open(builder.mirrorPath(member.sucatalog_url)) as sucatalog_file:
+            catalog = plistlib.readPlist(sucatalog_file)
+        self.assertEqual(catalog['Products'].keys(), ['091-00035'])
+        product = catalog['Products']['091-00035']
+        urls = [product['ServerMetadataURL']] + [url for package in product['Packages'] for url in [package['URL'], package['MetadataURL']]]
+        self.assertEqual(len(urls), 7)
+        for url in urls:
+            self.assertTrue(url.startswith(self.mirror_url + '/'), url)
+            self.assertTrue(os.path.isfile(builder.mirrorPath(url)), url)
+
+        # A client of the mirror picks the same packages as one going to the source
+        source = self.newXcodeCLI('source', self.base_url)
+        source.processSUCatalog()
+        client = self.newXcodeCLI('client', self.mirror_url)
+        client.processSUCatalog()
+        self.assertEqual(sorted(client.packages_to_process), sorted(source.packages_to_process))
+        for pkg, package in client.packages_to_process.items():
+            self.assertEqual(package['long_version'], source.packages_to_process[pkg]['long_version'])
+            self.assertEqual(package['digest'], source.packages_to_process[pkg]['digest'])
+
+        client.downloadPkgs(client.packages_to_process.values())
+        for package in client.packages_to_process.values():
+            with open(package['download_name'], 'rb') as client_file, open(builder.mirrorPath(package['url']), 'rb') as mirror_file:
+                self.assertEqual(client_file.read(), mirror_file.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
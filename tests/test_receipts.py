@@ -0,0 +1,108 @@
+'''Tests for reading package receipts and flat packages, and planning installs from them, against the fixtures in tests/fixtures.'''
+
+import os  # NOQA
+import shutil  # NOQA
+import tempfile  # NOQA
+import unittest  # NOQA
+
+import xcodetools  # NOQA
+
+from datetime import datetime  # NOQA
+
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+class ReadPlistTest(unittest.TestCase):
+    def testBinaryPlist(self):
+        '''values.plist was written by Python 3's plistlib, which uses the smallest integer size that fits and signed 8 byte integers for negatives.'''
+        values = xcodetools.readPlistFile(os.path.join(fixtures_dir, 'values.plist'))
+        self.assertEqual(values['Negative'], -5)
+        self.assertEqual(values['NegativeLarge'], -123456789012)
+        self.assertEqual(values['Nested'], {'Inner': ['x', {'Deep': -1}]})
+        self.assertEqual([values[key] for key in ['Zero', 'Small', 'Medium', 'Large', 'Huge', 'Unsigned64']], [0, 200, 40000, 3000000000, 123456789012, 2 ** 64 - 1])
+        self.assertEqual(values['Float'], 2.5)
+        self.assertIs(values['True'], True)
+        self.assertIs(values['False'], False)
+        self.assertEqual(values['Date'], datetime(2018, 8, 1, 12, 30, 15))
+        self.assertEqual(values['Data'].data, '\x00\x01binary\xff')
+        self.assertEqual(values['Ascii'], 'short')
+        self.assertEqual(values['LongAscii'], 'a string longer than fifteen bytes')
+        self.assertEqual(values['Unicode'], u'Caf\xe9 \u2615')
+        self.assertEqual(values['Array'], range(20))
+
+    def testXMLPlist(self):
+        receipt = xcodetools.readPlistFile(os.path.join(fixtures_dir, 'receipts', 'com.apple.pkg.CLTools_SDK_macOS1014.plist'))
+        self.assertEqual(receipt['PackageIdentifier'], 'com.apple.pkg.CLTools_SDK_macOS1014')
+        self.assertEqual(receipt['PackageVersion'], '10.2.0.0.1.1500000000')
+
+
+class ReadPackageInfoTest(unittest.TestCase):
+    def testComponentPackage(self):
+        components = xcodetools.readPackageInfo(os.path.join(fixtures_dir, 'packages', 'CLTools_Executables.pkg'))
+        self.assertEqual(components, [{'pkg_identifier': 'com.apple.pkg.CLTools_Executables', 'long_version': '10.2.0.0.1.1500000001'}])
+
+    def testProductArchive(self):
+        '''A product archive has a PackageInfo in each component's folder, stored compressed or not.'''
+        components = xcodetools.readPackageInfo(os.path.join(fixtures_dir, 'packages', 'XcodeExtras.pkg'))
+        self.assertEqual(components, [
+            {'pkg_identifier': 'com.apple.pkg.MobileDevice', 'long_version': '1.0.0.0.1.1500000000'},
+            {'pkg_identifier': 'com.apple.pkg.MobileDeviceDevelopment', 'long_version': '2.0.0.0.1.1500000000'},
+        ])
+
+    def testNotAPackage(self):
+        self.assertRaises(ValueError, xcodetools.readPackageInfo, os.path.join(fixtures_dir, 'packages', 'NotAPackage.pkg'))
+
+
+class InstallPlannerTest(unittest.TestCase):
+    def setUp(self):
+        self.planner = xcodetools.InstallPlanner(os.path.join(fixtures_dir, 'receipts'))
+
+    def package(self, pkg_identifier, long_version):
+        return {'pkg_identifier': pkg_identifier, 'long_version': long_version}
+
+    def testReceipts(self):
+        '''Binary and XML receipts are read, and one that can't be read is left out.'''
+        self.assertEqual(self.planner.readReceipts(), {
+            'com.apple.pkg.CLTools_Executables': '10.2.0.0.1.1500000000',
+            'com.apple.pkg.CLTools_SDK_macOS1014': '10.2.0.0.1.1500000000',
+        })
+
+    def testPlan(self):
+        packages = [
+            self.package('com.apple.pkg.CLTools_Executables', '10.2.0.0.1.1500000001'),
+            self.package('com.apple.pkg.CLTools_SDK_macOS1014', '10.2.0.0.1.1500000000'),
+            self.package('com.apple.pkg.CLTools_SDK_macOS1014', '10.1.0.0.1.1400000000'),
+            self.package('com.apple.pkg.DevSDK_macOS1014', '10.2.0.0.1.1500000000'),
+        ]
+        plan = self.planner.plan(packages)
+        self.assertEqual([(package, action, installed_version) for package, action, installed_version in plan], [
+            (packages[0], 'upgrade', '10.2.0.0.1.1500000000'),
+            (packages[1], 'skip', '10.2.0.0.1.1500000000'),
+            (packages[2], 'skip', '10.2.0.0.1.1500000000'),
+            (packages[3], 'install', None),
+        ])
+
+    def testPlanFromPackage(self):
+        plan = self.planner.plan(xcodetools.readPackageInfo(os.path.join(fixtures_dir, 'packages', 'CLTools_Executables.pkg')))
+        self.assertEqual([action for _, action, _ in plan], ['upgrade'])
+
+    def testReceiptsReadOnce(self):
+        '''Receipts are read the first time they're needed, and not again for later plans.'''
+        receipts_dir = tempfile.mkdtemp(prefix='xcodetools_test.')
+        try:
+            shutil.copy(os.path.join(fixtures_dir, 'receipts', 'com.apple.pkg.CLTools_Executables.plist'), receipts_dir)
+            planner = xcodetools.InstallPlanner(receipts_dir)
+            package = self.package('com.apple.pkg.CLTools_Executables', '10.2.0.0.1.1500000000')
+            self.assertEqual(planner.plan([package])[0][1], 'skip')
+            os.remove(os.path.join(receipts_dir, 'com.apple.pkg.CLTools_Executables.plist'))
+            self.assertEqual(planner.plan([package])[0][1], 'skip')
+        finally:
+            shutil.rmtree(receipts_dir)
+
+    def testMissingReceiptsDir(self):
+        planner = xcodetools.InstallPlanner(os.path.join(fixtures_dir, 'no-such-folder'))
+        self.assertEqual(planner.plan([self.package('com.apple.pkg.CLTools_Executables', '10.2.0.0.1.1500000000')])[0][1], 'install')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+'''Tests for TransferScheduler ordering and pacing fetches from a local server.'''
+
+import os  # NOQA
+import threading  # NOQA
+import time  # NOQA
+import unittest  # NOQA
+
+import xcodetools  # NOQA
+
+from tests.support import ServerTestCase, payload  # NOQA
+
+
+class RecordingScheduler(xcodetools.TransferScheduler):
+    '''Records the priority of each transfer as it starts, and the most transfers that were active at once.'''
+    def __init__(self, **kwargs):
+        xcodetools.TransferScheduler.__init__(self, **kwargs)
+        self.started = []
+        self.most_active = 0
+
+    def acquire(self, priority):
+        xcodetools.TransferScheduler.acquire(self, priority)
+        with self.slots:
+            self.started.append(priority)
+            self.most_active = max(self.most_active, self.active)
+
+
+class TransferSchedulerTest(ServerTestCase):
+    def newXcodeCLI(self, **kwargs):
+        scheduler = RecordingScheduler(**kwargs)
+        # No allowance is saved up, so the pacing can be timed from the first byte
+        scheduler.burst = 0
+        # Without a base_url the URLs are fetched from the hosts they name, so a second name for the server counts as another host
+        return xcodetools.XcodeCLI(cache_dir=os.path.join(self.temp_dir, 'cache'), destination=os.path.join(self.temp_dir, 'dest'), mac_os_ver='10.14',
+                                   no_cache=True, quiet=True, scheduler=scheduler, transport=self.transport)
+
+    def fetch(self, xcode, urls, kind='package'):
+        '''Reads every URL at once, each in its own thread, and returns how long it took.'''
+        def read(url):
+            response = xcode.openURL(url, kind=kind)
+            while response.read(16384):
+                pass
+        threads = [threading.Thread(target=read, args=(url,)) for url in urls]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.time() - start
+
+    def testMaxTransfers(self):
+        xcode = self.newXcodeCLI(max_transfers=2, max_rate=512 * 1024)
+        urls = [self.writeSiteFile('/downloads/{}/CLTools_Executables.pkg'.format(number), payload(str(number), 64 * 1024)) for number in range(6)]
+        self.fetch(xcode, urls)
+        self.assertEqual(len(xcode.scheduler.started), 6)
+        self.assertEqual(xcode.scheduler.most_active, 2)
+        self.assertEqual(xcode.scheduler.active, 0)
+
+    def testPriorityOrder(self):
+        '''Once a slot frees up, waiting transfers start catalogs and metadata first, then Remove packages, CLTools and SDKs last.'''
+        xcode = self.newXcodeCLI(max_transfers=1)
+        scheduler = xcode.scheduler
+        names = ['CLTools_SDK_macOS1014.pkg', 'CLTools_Executables.pkg', 'RemoveCLTools_OldSDK.pkg', 'CLTools_Executables.pkm']
+        kinds = ['package', 'package', 'package', 'metadata']
+        urls = [self.writeSiteFile('/downloads/{}'.format(name), payload(name, 1024)) for name in names]
+
+        # The only slot is held until every transfer is waiting for it, which they start doing lowest priority first
+        scheduler.acquire(0)
+        threads = []
+        for url, kind in zip(urls, kinds):
+            threads.append(threading.Thread(target=self.fetch, args=(xcode, [url], kind)))
+            threads[-1].start()
+            while len(scheduler.waiting) < len(threads):
+                time.sleep(0.01)
+        scheduler.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(scheduler.started, [0, 0, 1, 2, 3])
+
+    def testMaxRate(self):
+        '''Transfers share max_rate, two 128KB files at 256KB/s take about a second between them.'''
+        xcode = self.newXcodeCLI(max_rate=256 * 1024)
+        urls = [self.writeSiteFile('/downloads/{}/CLTools_Executables.pkg'.format(number), payload(str(number), 128 * 1024)) for number in range(2)]
+        elapsed = self.fetch(xcode, urls)
+        self.assertGreater(elapsed, 0.8)
+        self.assertLess(elapsed, 2.0)
+
+    def testMaxHostRate(self):
+        '''max_host_rate paces each host on its own, so two hosts together get twice the rate of one.'''
+        xcode = self.newXcodeCLI(max_host_rate=128 * 1024)
+        url = self.writeSiteFile('/downloads/CLTools_Executables.pkg', payload('CLTools_Executables', 128 * 1024))
+        other_host_url = url.replace('127.0.0.1', 'localhost')
+
+        elapsed = self.fetch(xcode, [url, url])
+        self.assertGreater(elapsed, 1.8)
+        self.assertLess(elapsed, 3.0)
+
+        elapsed = self.fetch(xcode, [url, other_host_url])
+        self.assertGreater(elapsed, 0.8)
+        self.assertLess(elapsed, 1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+'''Tests for PackageStore fetching packages from a local server.'''
+
+import hashlib  # NOQA
+import os  # NOQA
+import threading  # NOQA
+import time  # NOQA
+import unittest  # NOQA
+
+import xcodetools  # NOQA
+
+from tests.support import ServerTestCase, payload  # NOQA
+
+
+class PackageStoreTest(ServerTestCase):
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.data = payload('CLTools_SDK_macOS1014', 200000)
+        self.digest = hashlib.sha1(self.data).hexdigest()
+        self.url = self.writeSiteFile('/downloads/CLTools_SDK_macOS1014.pkg', self.data)
+        self.store = xcodetools.PackageStore(os.path.join(self.temp_dir, 'packages'))
+
+    def download(self, url, output_file, size=None, digest=None):
+        xcodetools.SegmentedDownload(url, output_file, self.openURL, size=size, digest=digest, segment_size=65536).run()
+
+    def fetch(self):
+        return self.store.fetch(self.url, self.download, size=len(self.data), digest=self.digest)
+
+    def readFile(self, path):
+        with open(path, 'rb') as stored_file:
+            return stored_file.read()
+
+    def testFetch(self):
+        path = self.fetch()
+        self.assertEqual(path, self.store.path(self.url, self.digest))
+        self.assertEqual(self.readFile(path), self.data)
+        self.assertTrue(self.store.contains(self.url, self.digest))
+
+        # Fetching a stored package again only checks it
+        self.requests = []
+        self.fetch()
+        self.assertEqual(self.requests, [])
+
+    def testLink(self):
+        '''Download names are links to the one stored copy.'''
+        path = self.fetch()
+        names = [os.path.join(self.temp_dir, 'dest', '10.13', 'CLTools_SDK_macOS1014.pkg'), os.path.join(self.temp_dir, 'dest', '10.14', 'CLTools_SDK_macOS1014.pkg')]
+        for name in names:
+            self.store.link(path, name)
+            self.assertTrue(os.path.samefile(path, name))
+
+    def testTruncatedObjectRefetched(self):
+        path = self.fetch()
+        with open(path, 'r+b') as stored_file:
+            stored_file.truncate(1000)
+        self.requests = []
+        self.assertEqual(self.readFile(self.fetch()), self.data)
+        self.assertNotEqual(self.requests, [])
+
+    def testCorruptObjectRefetched(self):
+        '''A stored package changed since it was verified is checked against its digest, and fetched again as it no longer matches.'''
+        path = self.fetch()
+        with open(path, 'r+b') as stored_file:
+            stored_file.seek(5000)
+            stored_file.write('corrupt')
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.requests = []
+        self.assertEqual(self.readFile(self.fetch()), self.data)
+        self.assertNotEqual(self.requests, [])
+
+    def testSameDigestFetchedOnce(self):
+        '''Packages at different URLs with the same digest are one stored file, so fetching both at once only downloads it once.'''
+        data = payload('CLTools_Executables', 4 * 1024 * 1024)
+        digest = hashlib.sha1(data).hexdigest()
+        urls = [self.writeSiteFile('/downloads/{}/CLTools_Executables.pkg'.format(product), data) for product in ['091-00001', '091-00002']]
+        paths, errors = [], []
+
+        def fetch(url):
+            try:
+                paths.append(self.store.fetch(url, self.download, size=len(data), digest=digest))
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=fetch, args=(url,)) for url in urls]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(paths, [self.store.path(urls[0], digest)] * 2)
+        self.assertEqual(self.readFile(paths[0]), data)
+        self.assertEqual(self.rangeStarts(), range(0, len(data), 65536))
+
+    def testEviction(self):
+        '''Least recently used packages are removed once the store is over its size, but not ones used by this run.'''
+        self.store.fetch(self.url, self.download, size=len(self.data), digest=self.digest)
+        store = xcodetools.PackageStore(self.store.store_dir, max_size=len(self.data) * 3 // 2)
+        other = payload('CLTools_Executables', len(self.data))
+        other_url = self.writeSiteFile('/downloads/CLTools_Executables.pkg', other)
+        store.fetch(other_url, self.download, size=len(other), digest=hashlib.sha1(other).hexdigest())
+        self.assertFalse(store.contains(self.url, self.digest))
+        self.assertTrue(store.contains(other_url, hashlib.sha1(other).hexdigest()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,16 +3,54 @@
 '''Programatically agree to the XCode license after XCode is installed.
 Based on work done by Tim Sutton: https://macops.ca/deploying-xcode-the-trick-with-accepting-license-agreements/'''
 
+import argparse
 import plistlib
 import subprocess
 
 from glob import glob
 
+# The receipts are checked with xcodetools.py when it sits alongside this script, without it every package is installed as before
+try:
+    from xcodetools import InstallPlanner, readPackageInfo
+except ImportError:
+    InstallPlanner, readPackageInfo = None, None
+
 xcodePrefs = '/Library/Preferences/com.apple.dt.Xcode.plist'
 licenseInfo = '/Applications/Xcode.app/Contents/Resources/LicenseInfo.plist'
 xcodeInfo = '/Applications/Xcode.app/Contents/Info.plist'
 installPkgs = True
 
+parser = argparse.ArgumentParser(description='Agrees to the Xcode license and installs the additional packages that come with Xcode.')
+parser.add_argument(
+    '-n', '--dry-run',
+    action='store_true',
+    dest='dry_run',
+    help='Dry run only, prints what would be installed without writing the license file or installing anything.',
+    required=False
+)
+parser.add_argument(
+    '--receipts-dir',
+    type=str,
+    nargs=1,
+    dest='receipts_dir',
+    metavar='<receipts path>',
+    help='Specify alternative folder of installed package receipts used to skip packages that are already up to date. Defaults to /var/db/receipts.',
+    required=False
+)
+parser.add_argument(
+    '--reinstall',
+    action='store_true',
+    dest='reinstall',
+    help='Install packages even if the receipts show the same or a newer version is already installed.',
+    required=False
+)
+args = parser.parse_args()
+
+if args.receipts_dir and len(args.receipts_dir) is 1:
+    receiptsDir = args.receipts_dir[0]
+else:
+    receiptsDir = '/var/db/receipts'
+
 # Accept the EULA
 try:
     # Empty dict to use to write out the license agreed plist.
@@ -33,18 +71,41 @@ try:
         acceptedLicense['IDEXcodeVersionForAgreedToBetaLicense'] = xcode_version
         acceptedLicense['IDELastBetaLicenseAgreedTo'] = xcodeLicense['licenseID']
 
-    print 'Writing license file'
-    plistlib.writePlist(acceptedLicense, xcodePrefs)
+    if args.dry_run:
+        print 'Would write license file'
+    else:
+        print 'Writing license file'
+        plistlib.writePlist(acceptedLicense, xcodePrefs)
 except Exception as e:
     raise e
 
 
-# Install all the additional packages
+# Install all the additional packages, other than those the receipts show are already up to date
 if installPkgs:
     packages = glob('/Applications/Xcode.app//Contents/Resources/Packages/*.pkg')
+    if InstallPlanner:
+        planner = InstallPlanner(receiptsDir)
+    else:
+        planner = None
+        print 'xcodetools.py not found alongside this script, installing every package without checking the receipts'
 
 # Loop the packages to install
     for pkg in packages:
+        try:
+            plan = planner.plan(readPackageInfo(pkg)) if planner else []
+        except Exception:
+            # Can't tell what's in it, so install it as before
+            plan = []
+
+        if plan and not args.reinstall and all(action == 'skip' for _, action, _ in plan):
+            print 'Skipping {}, already up to date'.format(pkg)
+            continue
+        print '{} {}'.format('Would install' if args.dry_run else 'Installing', pkg)
+        for package, action, installedVersion in plan:
+            print '    {} {} {}{}'.format(action, package['pkg_identifier'], package['long_version'], ' (installed {})'.format(installedVersion) if installedVersion else '')
+        if args.dry_run:
+            continue
+
         try:
             subprocess.check_call(['/usr/sbin/installer', '-pkg', pkg, '-target', '/'])
         except Exception as e:
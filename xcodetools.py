@@ -3,41 +3,1187 @@
 '''Downloads the Xcode CLI tools using the Apple Software Update catalog.'''
 
 import argparse  # NOQA
+import base64  # NOQA
+import BaseHTTPServer  # NOQA
+import contextlib  # NOQA
+import cProfile  # NOQA
+import ctypes  # NOQA
+import ctypes.util  # NOQA
+import errno  # NOQA
 import gzip  # NOQA
-import xml.etree.ElementTree as ET  # NOQA
+import hashlib  # NOQA
+import heapq  # NOQA
+import httplib  # NOQA
+import itertools  # NOQA
+import json  # NOQA
 import os  # NOQA
 import plistlib  # NOQA
+import posixpath  # NOQA
+import Queue  # NOQA
+import random  # NOQA
+import re  # NOQA
+import socket  # NOQA
+import SocketServer  # NOQA
+import sqlite3  # NOQA
 import shutil  # NOQA
+import signal  # NOQA
+import struct  # NOQA
 import subprocess  # NOQA
 import sys  # NOQA
+import threading  # NOQA
+import time  # NOQA
+import urllib  # NOQA
+import urlparse  # NOQA
+import zlib  # NOQA
 
+from collections import deque, OrderedDict  # NOQA
+from datetime import datetime, timedelta  # NOQA
 from distutils.version import LooseVersion  # NOQA
+from glob import glob  # NOQA
+from multiprocessing.pool import ThreadPool  # NOQA
 from platform import mac_ver  # NOQA
 from pprint import pprint  # NOQA
+from StringIO import StringIO  # NOQA
+
+
+# The C ElementTree parses catalogs several times faster, where the Python build has it
+try:
+    import xml.etree.cElementTree as ET  # NOQA
+except ImportError:
+    import xml.etree.ElementTree as ET  # NOQA
+
+# sendfile() from libc for serving mirrored files without copying them through Python, where the platform has it
+try:
+    sendfile_call = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).sendfile
+    if sys.platform == 'darwin':
+        sendfile_call.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.POINTER(ctypes.c_int64), ctypes.c_void_p, ctypes.c_int]
+        sendfile_call.restype = ctypes.c_int
+    elif sys.platform.startswith('linux'):
+        sendfile_call.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+        sendfile_call.restype = ctypes.c_ssize_t
+    else:
+        sendfile_call = None
+except Exception:
+    sendfile_call = None
+
+
+class GzipStream():
+    '''File like object that decompresses gzip data as it is read from another file like object, such as a pipe.'''
+    '''gzip.GzipFile can't be used for this as it needs to seek in the underlying file.'''
+    def __init__(self, fileobj, chunk_size=65536):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = ''
+        self.eof = False
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            chunk = self.fileobj.read(self.chunk_size)
+            if chunk:
+                self.buffer += self.decompressor.decompress(chunk)
+            else:
+                self.buffer += self.decompressor.flush()
+                self.eof = True
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def makeDirs(path):
+    '''Creates a folder and any missing parents, unless it already exists. Another thread or process creating it first is fine.'''
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def poolMap(func, items, processes):
+    '''Returns [func(item) for item in items], worked through by a pool of processes threads. Unlike ThreadPool.map(), Ctrl-C still'''
+    '''interrupts the wait on Python 2, rather than only once every item is done. Items already started are abandoned to finish on'''
+    '''their own, as the pool's threads are daemons.'''
+    pool = ThreadPool(processes=processes)
+    try:
+        result = pool.map_async(func, items)
+        # A wait without a timeout can't be interrupted on Python 2
+        while not result.ready():
+            result.wait(0.5)
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    return result.get()
+
+
+def plistElementToObject(element):
+    '''Converts a parsed plist XML element into the same object plistlib would return for it.'''
+    if element.tag == 'dict':
+        children = list(element)
+        return dict((children[i].text or '', plistElementToObject(children[i + 1])) for i in range(0, len(children), 2))
+    elif element.tag == 'array':
+        return [plistElementToObject(child) for child in element]
+    elif element.tag == 'integer':
+        return int(element.text)
+    elif element.tag == 'real':
+        return float(element.text)
+    elif element.tag == 'true':
+        return True
+    elif element.tag == 'false':
+        return False
+    elif element.tag == 'date':
+        # Parsed the same way as plistlib, datetime.strptime isn't safe to call from several threads at once in Python 2
+        return datetime(*[int(part) for part in re.findall(r'\d+', element.text)[:6]])
+    elif element.tag == 'data':
+        return plistlib.Data(base64.b64decode(element.text or ''))
+    else:
+        return element.text or ''
+
+
+def readBinaryPlist(data):
+    '''Returns the object in a binary (bplist00) property list. plistlib only reads XML ones in Python 2, but package receipts are binary.'''
+    offset_size, ref_size, count, top, table_offset = struct.unpack('>6xBBQQQ', data[-32:])
+
+    def number(start, size):
+        return int(data[start:start + size].encode('hex'), 16)
+
+    offsets = [number(table_offset + i * offset_size, offset_size) for i in range(count)]
+
+    def length(start, info):
+        '''Returns an object's length and where its content starts. Lengths that don't fit in the marker follow it as an int object.'''
+        if info != 0xF:
+            return info, start + 1
+        size = 1 << (ord(data[start + 1]) & 0xF)
+        return number(start + 2, size), start + 2 + size
+
+    def read(ref):
+        start = offsets[ref]
+        marker = ord(data[start])
+        kind, info = marker >> 4, marker & 0xF
+        if marker == 0x08:
+            return False
+        elif marker == 0x09:
+            return True
+        elif kind == 0x0:
+            return None
+        elif kind == 0x1:
+            # 1, 2 and 4 byte integers are unsigned, 8 and 16 byte ones are signed
+            value = number(start + 1, 1 << info)
+            if info >= 3 and value >= 1 << ((8 << info) - 1):
+                value -= 1 << (8 << info)
+            return value
+        elif kind == 0x2:
+            return struct.unpack('>f' if info == 2 else '>d', data[start + 1:start + 1 + (1 << info)])[0]
+        elif kind == 0x3:
+            return datetime(2001, 1, 1) + timedelta(seconds=struct.unpack('>d', data[start + 1:start + 9])[0])
+        elif kind == 0x8:
+            return number(start + 1, info + 1)
+
+        size, content = length(start, info)
+        if kind == 0x4:
+            return plistlib.Data(data[content:content + size])
+        elif kind == 0x5:
+            return data[content:content + size]
+        elif kind == 0x6:
+            return data[content:content + size * 2].decode('utf-16-be')
+        elif kind == 0xA:
+            return [read(number(content + i * ref_size, ref_size)) for i in range(size)]
+        elif kind == 0xD:
+            return dict((read(number(content + i * ref_size, ref_size)), read(number(content + (size + i) * ref_size, ref_size))) for i in range(size))
+        raise ValueError('Unsupported binary plist object 0x{:02x}'.format(marker))
+
+    return read(top)
+
+
+def readPlistFile(path):
+    '''Returns the object in an XML or binary property list file.'''
+    with open(path, 'rb') as plist_file:
+        data = plist_file.read()
+    if data.startswith('bplist00'):
+        return readBinaryPlist(data)
+    return plistlib.readPlistFromString(data)
+
+
+def readPackageInfo(pkg_path):
+    '''Returns the pkg_identifier and long_version of each component in a flat package, read from the PackageInfo files in its xar'''
+    '''archive without extracting it. A component package has one PackageInfo, a product archive one for each of its components.'''
+    with open(pkg_path, 'rb') as pkg_file:
+        # xar header, then the zlib compressed XML table of contents, then the heap the table of contents gives offsets into
+        magic, header_size, _, toc_length, _, _ = struct.unpack('>4sHHQQI', pkg_file.read(28))
+        if magic != 'xar!':
+            raise ValueError('{} is not a flat package'.format(pkg_path))
+        pkg_file.seek(header_size)
+        toc = ET.fromstring(zlib.decompress(pkg_file.read(toc_length)))
+        heap = header_size + toc_length
+
+        components = []
+        for entry in toc.iter('file'):
+            if entry.findtext('name') != 'PackageInfo' or entry.find('data') is None:
+                continue
+            pkg_file.seek(heap + int(entry.findtext('data/offset')))
+            content = pkg_file.read(int(entry.findtext('data/length')))
+            encoding = entry.find('data/encoding').get('style') if entry.find('data/encoding') is not None else 'application/octet-stream'
+            if encoding == 'application/x-gzip':
+                # Despite the name xar uses zlib streams, this accepts either
+                content = zlib.decompress(content, 32 + zlib.MAX_WBITS)
+            elif encoding != 'application/octet-stream':
+                raise ValueError('{} has a PackageInfo with unsupported encoding {}'.format(pkg_path, encoding))
+            package_info = ET.fromstring(content)
+            components.append({'pkg_identifier': package_info.get('identifier'), 'long_version': package_info.get('version')})
+        return components
+
+
+class InstallPlanner():
+    '''Works out which packages need installing by comparing their pkg_identifier and long_version with the installed package receipts,'''
+    '''so packages that are already up to date aren't installed again. The receipts are only read once, the first time they're needed.'''
+    def __init__(self, receipts_dir='/var/db/receipts'):
+        self.receipts_dir = receipts_dir
+        self.installed = None
+
+    def readReceipts(self):
+        '''Returns the installed package versions keyed by package identifier.'''
+        if self.installed is None:
+            self.installed = {}
+            for receipt_file in glob(os.path.join(self.receipts_dir, '*.plist')):
+                try:
+                    receipt = readPlistFile(receipt_file)
+                    self.installed[receipt['PackageIdentifier']] = receipt['PackageVersion']
+                except Exception:
+                    # A receipt that can't be read is the same as the package not being installed, the worst case is installing it again
+                    continue
+        return self.installed
+
+    def plan(self, packages):
+        '''Returns a list of (package, action, installed version) in the same order as packages, where action is install if it isn't'''
+        '''installed, upgrade if an older version is, or skip if the same or a newer version is.'''
+        installed = self.readReceipts()
+        plan = []
+        for package in packages:
+            installed_version = installed.get(package['pkg_identifier'])
+            if installed_version is None:
+                action = 'install'
+            elif LooseVersion(installed_version) < LooseVersion(package['long_version']):
+                action = 'upgrade'
+            else:
+                action = 'skip'
+            plan.append((package, action, installed_version))
+        return plan
+
+
+class CurlResponse():
+    '''Response to a request made with curl. The body is read from curl's stdout as it arrives.'''
+    '''A transfer that fails part way raises subprocess.CalledProcessError from read() rather than looking like the end of the body.'''
+    def __init__(self, url, headers=None, timeout=None):
+        self.url = url
+        cmd = ['/usr/bin/curl', '--silent', '--show-error', '--fail', '-L', '--dump-header', '-']
+        if timeout:
+            cmd.extend(['--connect-timeout', str(timeout), '--max-time', str(timeout)])
+        for header in headers or []:
+            cmd.extend(['--header', header])
+        cmd.append(url)
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+        # Headers are written to stdout ahead of the body, with a block for each redirect that was followed
+        while True:
+            status_line = self.proc.stdout.readline()
+            if not status_line:
+                # Nothing at all comes back when curl fails outright
+                self.finish()
+                raise IOError('No response from {}'.format(url))
+            self.status, self.headers = int(status_line.split()[1]), {}
+            for line in iter(self.proc.stdout.readline, ''):
+                if not line.strip():
+                    break
+                name, _, value = line.partition(':')
+                self.headers[name.strip().lower()] = value.strip()
+            if not (self.status < 200 or (300 <= self.status < 400 and self.status != 304 and 'location' in self.headers)):
+                break
+
+    def read(self, size=-1):
+        data = self.proc.stdout.read(size)
+        if size < 0 or not data:
+            self.finish()
+        return data
+
+    def finish(self):
+        '''Waits for curl to exit, raising subprocess.CalledProcessError if the transfer failed.'''
+        if self.proc.wait() > 0:
+            raise subprocess.CalledProcessError(self.proc.returncode, self.url)
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+        self.proc.wait()
+        self.proc.stdout.close()
+
+
+class CurlTransport():
+    '''Makes requests by running curl, one process per request. The fallback for when HTTPTransport() can't be used.'''
+    def open(self, url, headers=None, timeout=None):
+        return CurlResponse(url, headers=headers, timeout=timeout)
+
+
+class HTTPResponse():
+    '''Response to a request made by HTTPTransport(). The connection goes back to the pool once the body has been read.'''
+    def __init__(self, transport, key, connection, response):
+        self.transport = transport
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+        self.headers = dict((name.lower(), value) for name, value in response.getheaders())
+
+    def read(self, size=-1):
+        if self.response is None:
+            return ''
+        data = self.response.read() if size < 0 else self.response.read(size)
+        if size < 0 or not data:
+            self.close()
+        return data
+
+    def close(self):
+        if self.response is None:
+            return
+        # Small leftovers are read so the connection can be reused, anything bigger isn't worth waiting for
+        if self.response.length is not None and self.response.length <= 65536:
+            try:
+                self.response.read()
+            except (httplib.HTTPException, socket.error):
+                pass
+        if self.response.isclosed() and not self.response.will_close:
+            self.transport.release(self.key, self.connection)
+        else:
+            self.connection.close()
+        self.response = None
+
+
+class HTTPTransport():
+    '''Makes requests in process with httplib. Connections are kept alive and pooled per host, so only the first request to a'''
+    '''host pays for connecting and the TLS handshake. Headers are given as 'Name: value' strings, the same as curl.'''
+    def __init__(self, max_idle=8, user_agent='xcodetools', metrics=None):
+        self.max_idle = max_idle
+        self.user_agent = user_agent
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.pools = {}
+
+    def connection(self, key, timeout, fresh=False):
+        '''Returns an idle connection to the host from the pool, or a new one, and whether it was reused.'''
+        with self.lock:
+            idle = self.pools.get(key)
+            if idle and not fresh:
+                connection = idle.pop()
+                connection.timeout = timeout
+                if connection.sock:
+                    connection.sock.settimeout(timeout)
+                return connection, True
+        scheme, netloc = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=timeout), False
+        return httplib.HTTPConnection(netloc, timeout=timeout), False
+
+    def release(self, key, connection):
+        with self.lock:
+            idle = self.pools.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def open(self, url, headers=None, timeout=None):
+        request_headers = {'User-Agent': self.user_agent}
+        for header in headers or []:
+            name, _, value = header.partition(':')
+            request_headers[name.strip()] = value.strip()
+
+        for redirect in range(10):
+            parts = urlparse.urlsplit(url)
+            key = (parts.scheme, parts.netloc)
+            path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            fresh = False
+            while True:
+                connection, reused = self.connection(key, timeout, fresh=fresh)
+                if self.metrics:
+                    self.metrics.count('connections_reused' if reused else 'connections_opened')
+                try:
+                    connection.request('GET', path, headers=request_headers)
+                    response = HTTPResponse(self, key, connection, connection.getresponse())
+                    break
+                except (httplib.HTTPException, socket.error):
+                    connection.close()
+                    # The server may have closed a pooled connection while it sat idle, so try once more on a new one
+                    if not reused:
+                        raise
+                    if self.metrics:
+                        self.metrics.count('connection_retries')
+                    fresh = True
+
+            if response.status in [301, 302, 303, 307, 308] and response.headers.get('location'):
+                response.close()
+                url = urlparse.urljoin(url, response.headers['location'])
+                continue
+            if response.status >= 400:
+                response.close()
+                raise IOError('{} returned HTTP {}'.format(url, response.status))
+            return response
+        raise IOError('Too many redirects for {}'.format(url))
+
+
+class Metrics():
+    '''Thread safe timings and counters for a run: the time spent in each phase, every HTTP fetch with its duration and size, and'''
+    '''counts of retries and cache hits. Saved as a JSON report, or as a Prometheus textfile if the file name ends in .prom.'''
+    '''Phases that run concurrently, such as downloads and installs in a pipelined install, each count their own time. Only the most'''
+    '''recent max_fetches fetches are listed so a long running watch doesn't grow without limit, the totals include every one.'''
+    def __init__(self, max_fetches=10000):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self.fetch_totals = OrderedDict()
+        self.fetches = deque(maxlen=max_fetches)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''Context manager timing a phase. A phase that runs more than once adds up.'''
+        started = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                phase = self.phases.setdefault(name, {'count': 0, 'seconds': 0.0})
+                phase['count'] += 1
+                phase['seconds'] += time.time() - started
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def fetch(self, kind, url, started, status, transferred, error=None):
+        '''Records a finished HTTP fetch. kind is one of catalog, metadata or package.'''
+        fetch = {'kind': kind, 'url': url, 'started': started, 'seconds': time.time() - started, 'status': status, 'bytes': transferred}
+        if error:
+            fetch['error'] = error
+        with self.lock:
+            self.fetches.append(fetch)
+            totals = self.fetch_totals.setdefault(kind, {'count': 0, 'bytes': 0, 'seconds': 0.0, 'errors': 0})
+            totals['count'] += 1
+            totals['bytes'] += transferred
+            totals['seconds'] += fetch['seconds']
+            totals['errors'] += 1 if error else 0
+
+    def report(self):
+        '''Returns the metrics as a dictionary, with fetches totalled by kind as well as listed.'''
+        with self.lock:
+            return {
+                'started': self.started,
+                'seconds': time.time() - self.started,
+                'phases': dict((name, dict(phase)) for name, phase in self.phases.items()),
+                'counters': dict(self.counters),
+                'fetch_totals': dict((kind, dict(totals)) for kind, totals in self.fetch_totals.items()),
+                'fetches': list(self.fetches),
+            }
+
+    def prometheusText(self, report):
+        '''Returns a report in the Prometheus text exposition format, for the node exporter's textfile collector.'''
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append('# HELP xcodetools_{} {}'.format(name, help_text))
+            lines.append('# TYPE xcodetools_{} gauge'.format(name))
+            for labels, value in samples:
+                lines.append('xcodetools_{}{} {}'.format(name, '{{{}}}'.format(','.join('{}="{}"'.format(label, labels[label]) for label in sorted(labels))) if labels else '', repr(value)))
+
+        metric('last_run_timestamp_seconds', 'Time the last run started.', [({}, report['started'])])
+        metric('run_seconds', 'Duration of the last run.', [({}, report['seconds'])])
+        metric('phase_seconds', 'Time spent in each phase of the last run.', [({'phase': name}, phase['seconds']) for name, phase in report['phases'].items()])
+        metric('phase_runs', 'Number of times each phase ran in the last run.', [({'phase': name}, phase['count']) for name, phase in report['phases'].items()])
+        metric('fetches', 'HTTP fetches made in the last run.', [({'kind': kind}, totals['count']) for kind, totals in report['fetch_totals'].items()])
+        metric('fetch_bytes', 'Bytes received by HTTP fetches in the last run.', [({'kind': kind}, totals['bytes']) for kind, totals in report['fetch_totals'].items()])
+        metric('fetch_seconds', 'Time spent in HTTP fetches in the last run.', [({'kind': kind}, totals['seconds']) for kind, totals in report['fetch_totals'].items()])
+        metric('fetch_errors', 'HTTP fetches that failed in the last run.', [({'kind': kind}, totals['errors']) for kind, totals in report['fetch_totals'].items()])
+        metric('events', 'Retries, cache hits and other events in the last run.', [({'event': name}, value) for name, value in report['counters'].items()])
+        return '\n'.join(lines) + '\n'
+
+    def save(self, metrics_file):
+        report = self.report()
+        if metrics_file.endswith('.prom'):
+            data = self.prometheusText(report)
+        else:
+            data = json.dumps(report, indent=2, sort_keys=True) + '\n'
+        if os.path.dirname(metrics_file):
+            makeDirs(os.path.dirname(metrics_file))
+        # The textfile collector may read the file at any time, so it's replaced in one go
+        with open('{}.tmp'.format(metrics_file), 'w') as output_file:
+            output_file.write(data)
+        os.rename('{}.tmp'.format(metrics_file), metrics_file)
+
+
+class MeteredResponse():
+    '''Wraps a transport's response to record the fetch in Metrics() once its body has been read or it is closed. If a scheduler is'''
+    '''given, the body is read at the pace it allows and the transfer's slot is given back when it finishes.'''
+    def __init__(self, response, metrics, kind, url, started, scheduler=None, host=None):
+        self.response = response
+        self.metrics = metrics
+        self.kind = kind
+        self.url = url
+        self.started = started
+        self.scheduler = scheduler
+        self.host = host
+        self.status = response.status
+        self.headers = response.headers
+        self.transferred = 0
+        self.finished = False
+
+    def read(self, size=-1):
+        try:
+            data = self.response.read(size)
+        except Exception as e:
+            self.finish(error=str(e))
+            raise
+        self.transferred += len(data)
+        if self.scheduler and data:
+            self.scheduler.received(self.host, len(data))
+        if size < 0 or not data:
+            self.finish()
+        return data
+
+    def finish(self, error=None):
+        if not self.finished:
+            self.finished = True
+            self.metrics.fetch(self.kind, self.url, self.started, self.status, self.transferred, error=error)
+            if self.scheduler:
+                self.scheduler.release()
+
+    def close(self):
+        self.response.close()
+        self.finish()
+
+
+class TransferScheduler():
+    '''Thread safe scheduler every fetch goes through. At most max_transfers responses are open at once, and when a slot frees up it'''
+    '''goes to the waiting transfer with the highest priority: catalogs and metadata, then Remove packages, CLTools and SDKs last, so'''
+    '''the small packages needed first aren't stuck behind big SDKs. Reads are paced to stay under max_rate bytes/sec across all'''
+    '''transfers and max_host_rate bytes/sec to any one host. If progress is on, the aggregate throughput is shown on stderr.'''
+    # Seconds of unused allowance a transfer may use at once after a pause, so reads don't all have to be paced individually
+    burst = 1.0
+
+    # Seconds between updates of the throughput line, and of received data it is averaged over
+    display_interval = 0.5
+    display_window = 3.0
+
+    def __init__(self, max_rate=None, max_host_rate=None, max_transfers=8, progress=False, metrics=None):
+        self.max_rate = max_rate
+        self.max_host_rate = max_host_rate
+        self.max_transfers = max_transfers
+        self.progress = progress
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.slots = threading.Condition(threading.Lock())
+        self.waiting = []
+        self.tickets = itertools.count()
+        self.active = 0
+        self.ready = {}
+        self.transferred = 0
+        self.samples = deque()
+        self.busy_since = None
+        self.displayed = 0
+        self.line = ''
+
+    def priority(self, kind, url):
+        '''Returns the priority class of a fetch, lowest first. kind is one of catalog, metadata or package.'''
+        if kind != 'package':
+            return 0
+        name = os.path.basename(urlparse.urlsplit(url).path)
+        if 'Remove' in name:
+            return 1
+        if 'SDK' in name:
+            return 3
+        return 2
+
+    def acquire(self, priority):
+        '''Waits for a transfer slot, handing them out in priority order and first come first served within a priority.'''
+        with self.slots:
+            ticket = (priority, next(self.tickets))
+            heapq.heappush(self.waiting, ticket)
+            if self.active >= self.max_transfers and self.metrics:
+                self.metrics.count('transfers_queued')
+            while self.active >= self.max_transfers or self.waiting[0] != ticket:
+                self.slots.wait()
+            heapq.heappop(self.waiting)
+            self.active += 1
+            if self.busy_since is None:
+                self.busy_since = time.time()
+            # The next in line may be able to start too
+            self.slots.notify_all()
+
+    def release(self):
+        with self.slots:
+            self.active -= 1
+            if not self.active:
+                self.busy_since = None
+                self.clearDisplay()
+            self.slots.notify_all()
+
+    def received(self, host, count):
+        '''Records count bytes read from host, sleeping as long as it takes to keep under the rate limits.'''
+        now = time.time()
+        wait = 0
+        with self.lock:
+            for key, rate in [(None, self.max_rate), (host, self.max_host_rate)]:
+                if rate:
+                    # Each limit is booked ahead as data is read, the reader waits until its share of the allowance comes round
+                    self.ready[key] = max(self.ready.get(key, 0), now - self.burst) + float(count) / rate
+                    wait = max(wait, self.ready[key] - now)
+            self.transferred += count
+            self.samples.append((now, count))
+            while self.samples and self.samples[0][0] < now - self.display_window:
+                self.samples.popleft()
+            self.display(now)
+        if wait > 0:
+            if self.metrics:
+                self.metrics.count('throttled_seconds', wait)
+            time.sleep(wait)
+
+    def formatSize(self, size):
+        for unit in ['B', 'KB', 'MB']:
+            if size < 1024:
+                return '{:.1f} {}'.format(size, unit)
+            size /= 1024.0
+        return '{:.1f} GB'.format(size)
+
+    def display(self, now):
+        '''Updates the throughput line, once transfers have been going long enough for it to be worth showing.'''
+        busy_since = self.busy_since
+        if not self.progress or busy_since is None or now - busy_since < self.display_interval or now - self.displayed < self.display_interval:
+            return
+        self.displayed = now
+        elapsed = min(self.display_window, now - busy_since)
+        line = '{}/s, {} received, {} transfer(s) active, {} waiting'.format(
+            self.formatSize(sum(count for _, count in self.samples) / elapsed), self.formatSize(self.transferred), self.active, len(self.waiting))
+        sys.stderr.write('\r{}{}'.format(line, ' ' * max(0, len(self.line) - len(line))))
+        self.line = line
+
+    def clearDisplay(self):
+        with self.lock:
+            self.eraseLine()
+
+    def eraseLine(self):
+        '''Blanks the throughput line, self.lock must be held.'''
+        if self.line:
+            sys.stderr.write('\r{}\r'.format(' ' * len(self.line)))
+            self.line = ''
+
+    def write(self, message):
+        '''Prints a line of output. Downloads and installs print from several threads at once, so each line is written in one go and the'''
+        '''throughput line is cleared first so the two don't run together.'''
+        with self.lock:
+            self.eraseLine()
+            sys.stdout.write('{}\n'.format(message))
+            sys.stdout.flush()
+
+
+class SegmentedDownload():
+    '''Downloads a URL to a file as several concurrent byte range requests, or a single request if the server doesn't support ranges.'''
+    '''The file is assembled as <output_file>.part, with completed segments recorded in <output_file>.part.plist so an interrupted'''
+    '''download resumes with the segments it already has. The file only gets its real name once every byte has arrived.'''
+    '''When the expected size and digest are known they are checked as the data is written, and recorded in <output_file>.verified'''
+    '''once they match so later runs can skip the file without reading it again.'''
+    def __init__(self, url, output_file, open_url, size=None, digest=None, connections=4, segment_size=8 * 1024 * 1024, retries=3, metrics=None):
+        self.url = url
+        self.output_file = output_file
+        self.part_file = '{}.part'.format(output_file)
+        self.state_file = '{}.part.plist'.format(output_file)
+        self.record_file = '{}.verified'.format(output_file)
+        self.open_url = open_url
+        self.size = size
+        self.digest = digest.lower() if digest else None
+        self.connections = connections
+        self.segment_size = segment_size
+        self.retries = retries
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.digest_lock = threading.Lock()
+        self.state = None
+
+    def run(self):
+        # Nothing to fetch if the catalog says what the file should be and it already is
+        if self.size is not None and self.isComplete():
+            return
+
+        # One more attempt if the download doesn't match, rather than leaving a corrupt package behind
+        for attempt in range(2):
+            if attempt and self.metrics:
+                self.metrics.count('download_refetches')
+            if self.fetch() or self.verify():
+                return
+        raise IOError('{} still does not match the size or digest expected after downloading it again'.format(self.url))
+
+    def newHasher(self):
+        '''Returns a new hash object for the expected digest, SHA-1 as used by the catalog or SHA-256 by length.'''
+        if not self.digest:
+            return None
+        return hashlib.new('sha1' if len(self.digest) == 40 else 'sha256')
+
+    def fileDigest(self, path):
+        hasher = self.newHasher()
+        with open(path, 'rb') as check_file:
+            for chunk in iter(lambda: check_file.read(1048576), ''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def isComplete(self):
+        '''Returns True if the output file is already downloaded and matches, removing it if it doesn't.'''
+        if not os.path.exists(self.output_file):
+            return False
+
+        # A file recorded as verified when it was downloaded doesn't need to be read again
+        try:
+            record = plistlib.readPlist(self.record_file)
+        except Exception:
+            record = {}
+        if record and record['size'] == os.path.getsize(self.output_file) and record['mtime'] == os.path.getmtime(self.output_file) and record['size'] == self.size and record.get('digest') == self.digest:
+            return True
+
+        # Otherwise check it once. Most likely it was left truncated by an interrupted download before partial downloads were kept separately
+        if (self.size is not None and os.path.getsize(self.output_file) != self.size) or (self.digest and self.fileDigest(self.output_file) != self.digest):
+            os.remove(self.output_file)
+            return False
+        self.saveRecord()
+        return True
+
+    def fetch(self):
+        '''Downloads the URL to the partial download. Returns True if it turns out the output file is already complete.'''
+        # A one byte range request finds out the size and whether ranges are supported in one go
+        response = self.open_url(self.url, headers=['Range: bytes=0-0'])
+        try:
+            if response.status == 206 and '/' in response.headers.get('content-range', ''):
+                size = int(response.headers['content-range'].split('/')[1])
+                validator = response.headers.get('etag') or response.headers.get('last-modified') or ''
+            else:
+                # The server sent the whole file, so that is the download
+                size = int(response.headers.get('content-length', -1))
+                validator = None
+            if self.size is None and size >= 0:
+                self.size = size
+                if self.isComplete():
+                    return True
+            elif size >= 0 and size != self.size:
+                raise IOError('{} is {} bytes, expected {}'.format(self.url, size, self.size))
+            makeDirs(os.path.dirname(self.output_file))
+
+            self.hasher, self.hashed = self.newHasher(), 0
+            if validator is None:
+                self.segment_size, self.segment_written = sys.maxint, {}
+                open(self.part_file, 'wb').close()
+                self.fetchStream(response, 0, size)
+                return False
+        finally:
+            response.close()
+
+        # Resume from the state file unless the file on the server has changed since it was written
+        try:
+            self.state = plistlib.readPlist(self.state_file)
+        except Exception:
+            self.state = None
+        if not self.state or (self.state['url'], self.state['size'], self.state['validator'], self.state['segment_size']) != (self.url, size, validator, self.segment_size) or not os.path.exists(self.part_file):
+            self.state = {'url': self.url, 'size': size, 'validator': validator, 'segment_size': self.segment_size, 'completed': []}
+            with open(self.part_file, 'wb') as part_file:
+                part_file.truncate(size)
+            self.saveState()
+
+        # Segments that are already on disk are the only part of the file that needs reading back to check it
+        self.segment_written = dict((start, min(self.segment_size, size - start)) for start in self.state['completed'])
+        self.advanceDigest()
+
+        pending = [(start, min(start + self.segment_size, size) - 1) for start in range(0, size, self.segment_size) if start not in self.state['completed']]
+        if pending:
+            poolMap(self.fetchSegment, pending, min(self.connections, len(pending)))
+        return False
+
+    def saveState(self):
+        plistlib.writePlist(self.state, '{}.tmp'.format(self.state_file))
+        os.rename('{}.tmp'.format(self.state_file), self.state_file)
+
+    def saveRecord(self):
+        record = {'url': self.url, 'size': os.path.getsize(self.output_file), 'mtime': os.path.getmtime(self.output_file)}
+        if self.digest:
+            record['digest'] = self.digest
+        plistlib.writePlist(record, self.record_file)
+
+    def fetchSegment(self, segment):
+        start, end = segment
+        for attempt in range(self.retries):
+            try:
+                response = self.open_url(self.url, headers=['Range: bytes={}-{}'.format(start, end)])
+                try:
+                    if response.status != 206:
+                        raise IOError('{} did not return the requested range'.format(self.url))
+                    self.fetchStream(response, start, end - start + 1)
+                finally:
+                    response.close()
+                break
+            except Exception:
+                if attempt == self.retries - 1:
+                    raise
+                if self.metrics:
+                    self.metrics.count('segment_retries')
+
+        with self.lock:
+            self.state['completed'].append(start)
+            self.saveState()
+
+    def fetchStream(self, response, offset, length):
+        '''Writes a response body to the partial download at offset, checking the expected length arrived.'''
+        written = 0
+        self.segment_written[offset] = 0
+        # Unbuffered, so data can be read back for the digest as soon as it's written
+        with open(self.part_file, 'r+b', 0) as part_file:
+            part_file.seek(offset)
+            for chunk in iter(lambda: response.read(65536), ''):
+                part_file.write(chunk)
+                written += len(chunk)
+                self.segment_written[offset] = written
+                self.advanceDigest(offset + written - len(chunk), chunk)
+        if length >= 0 and written != length:
+            raise IOError('Expected {} bytes from {} but received {}'.format(length, self.url, written))
+
+    def advanceDigest(self, offset=None, chunk=None):
+        '''Hashes the file from the start as far as data has arrived contiguously. Chunks arriving in order are hashed as they are
+        written, anything that arrived ahead of them is read back once the gap is filled.'''
+        if self.hasher is None:
+            return
+        with self.digest_lock:
+            if chunk is not None and offset == self.hashed:
+                self.hasher.update(chunk)
+                self.hashed += len(chunk)
+            while True:
+                segment = self.hashed - self.hashed % self.segment_size
+                available = segment + self.segment_written.get(segment, 0)
+                if available <= self.hashed:
+                    break
+                with open(self.part_file, 'rb') as part_file:
+                    part_file.seek(self.hashed)
+                    while self.hashed < available:
+                        data = part_file.read(min(1048576, available - self.hashed))
+                        self.hasher.update(data)
+                        self.hashed += len(data)
+
+    def verify(self):
+        '''Gives the partial download its real name if it is the expected size and digest. Otherwise it's removed and False returned.'''
+        size = os.path.getsize(self.part_file)
+        if (self.size is None or size == self.size) and (self.hasher is None or (self.hashed == size and self.hasher.hexdigest() == self.digest)):
+            os.rename(self.part_file, self.output_file)
+            try:
+                os.remove(self.state_file)
+            except OSError:
+                pass
+            self.saveRecord()
+            return True
+
+        sys.stderr.write('{} does not match the size or digest expected, downloading again\n'.format(self.url))
+        for path in [self.part_file, self.state_file]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return False
+
+
+class MetadataCache():
+    '''Thread safe cache of parsed SMD/PKM metadata keyed by URL, optionally kept on disk between runs.'''
+    '''Entries are evicted least recently used first once there are more than max_entries.'''
+    def __init__(self, cache_file=None, max_entries=1024):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.modified = False
+
+        if self.cache_file and os.path.exists(self.cache_file):
+            try:
+                for entry in sorted(plistlib.readPlist(self.cache_file), key=lambda entry: entry['last_used']):
+                    self.entries[entry['url']] = entry
+            except Exception:
+                # A damaged cache is no worse than an empty one
+                self.entries = OrderedDict()
+            self.evict()
+
+    def evict(self):
+        '''Removes the least recently used entries until the cache is within max_entries.'''
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.modified = True
+
+    def get(self, url):
+        with self.lock:
+            entry = self.entries.pop(url, None)
+            if entry is None:
+                return None
+            entry['last_used'] = datetime.utcnow()
+            self.entries[url] = entry
+            self.modified = True
+            return dict(entry['metadata'])
+
+    def set(self, url, metadata):
+        with self.lock:
+            self.entries.pop(url, None)
+            self.entries[url] = {'url': url, 'metadata': dict(metadata), 'last_used': datetime.utcnow()}
+            self.modified = True
+            self.evict()
+
+    def save(self):
+        with self.lock:
+            if not self.cache_file or not self.modified:
+                return
+            makeDirs(os.path.dirname(self.cache_file))
+            plistlib.writePlist(self.entries.values(), '{}.tmp'.format(self.cache_file))
+            os.rename('{}.tmp'.format(self.cache_file), self.cache_file)
+            self.modified = False
+
+
+class PackageStore():
+    '''Thread safe store of downloaded packages kept between runs. Each package is stored once, named after its digest, or its URL if the'''
+    '''catalog doesn't give a digest, and download names are hardlinks to it so releases and later runs that want it share one copy.'''
+    '''Packages are evicted least recently used first once the store is bigger than max_size bytes, except those used by this run.'''
+    def __init__(self, store_dir, max_size=10 * 1024 * 1024 * 1024):
+        self.store_dir = store_dir
+        self.index_file = os.path.join(self.store_dir, 'index.plist')
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.in_use = set()
+        self.fetching = {}
+
+        if os.path.exists(self.index_file):
+            try:
+                for entry in plistlib.readPlist(self.index_file):
+                    self.entries[entry['key']] = entry
+            except Exception:
+                # A damaged index is rebuilt from the packages in the store
+                self.entries = {}
+
+        # Packages stored by a run whose index was overwritten by another are still counted, and ones removed by hand are forgotten
+        for key in self.entries.keys():
+            if not os.path.exists(self.objectPath(key)):
+                del self.entries[key]
+        if os.path.isdir(self.store_dir):
+            for name in os.listdir(self.store_dir):
+                if name.endswith('.pkg') and name[:-4] not in self.entries:
+                    path = os.path.join(self.store_dir, name)
+                    self.entries[name[:-4]] = {'key': name[:-4], 'url': '', 'size': os.path.getsize(path), 'last_used': datetime.utcfromtimestamp(os.path.getmtime(path))}
+
+    def key(self, url, digest=None):
+        if digest:
+            return digest.lower()
+        return 'url-{}'.format(hashlib.sha1(url).hexdigest())
+
+    def objectPath(self, key):
+        return os.path.join(self.store_dir, '{}.pkg'.format(key))
+
+    def path(self, url, digest=None):
+        '''Returns the path a package is, or would be, stored at.'''
+        return self.objectPath(self.key(url, digest))
+
+    def contains(self, url, digest=None):
+        return os.path.exists(self.path(url, digest))
+
+    def fetch(self, url, download, size=None, digest=None):
+        '''Returns the path of a package in the store, calling download(url, path, size=size, digest=digest) to fetch or check it first.'''
+        key = self.key(url, digest)
+        with self.lock:
+            self.in_use.add(key)
+            fetching = self.fetching.setdefault(key, threading.Lock())
+        # Packages at different URLs can have the same digest, so only one of them downloads it and the rest wait, then find it verified
+        with fetching:
+            download(url, self.objectPath(key), size=size, digest=digest)
+        with self.lock:
+            self.entries[key] = {'key': key, 'url': url, 'size': os.path.getsize(self.objectPath(key)), 'last_used': datetime.utcnow()}
+            self.evict()
+            self.save()
+        return self.objectPath(key)
+
+    def link(self, path, name):
+        '''Gives a stored package a download name, using a hardlink where possible so it takes no extra space.'''
+        if os.path.exists(name):
+            if os.path.samefile(path, name):
+                return
+            os.remove(name)
+        makeDirs(os.path.dirname(name))
+        try:
+            os.link(path, name)
+        except OSError:
+            # Most likely the download name is on another volume
+            shutil.copy2(path, name)
+
+    def evict(self):
+        '''Removes the least recently used packages until the store is within max_size, keeping any used by this run.'''
+        total = sum(entry['size'] for entry in self.entries.values())
+        for entry in sorted(self.entries.values(), key=lambda entry: entry['last_used']):
+            if total <= self.max_size:
+                break
+            if entry['key'] in self.in_use:
+                continue
+            for path in [self.objectPath(entry['key']), '{}.verified'.format(self.objectPath(entry['key']))]:
+                if os.path.exists(path):
+                    os.remove(path)
+            total -= entry['size']
+            del self.entries[entry['key']]
+
+    def save(self):
+        makeDirs(self.store_dir)
+        plistlib.writePlist(self.entries.values(), '{}.tmp'.format(self.index_file))
+        os.rename('{}.tmp'.format(self.index_file), self.index_file)
+
+
+class CatalogIndex():
+    '''SQLite index of the packages of interest in every catalog fetched, with their product, PostDate, size, digest and resolved'''
+    '''metadata, so they can be listed and searched without fetching anything. Updated in place as catalogs are fetched, only the'''
+    '''packages that were added, changed or removed since the last update are written. Safe to use from several threads.'''
+    columns = ['catalog_url', 'mac_os_ver', 'product_id', 'post_date', 'url', 'pkg', 'size', 'digest', 'smd_url', 'pkm_url', 'pkg_title', 'version', 'long_version', 'pkg_identifier']
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.lock = threading.Lock()
+        self.created = False
+
+    def connect(self):
+        '''Returns a new connection, as connections can't be shared between threads. Creates the index the first time.'''
+        with self.lock:
+            if not self.created:
+                if os.path.dirname(self.index_file):
+                    makeDirs(os.path.dirname(self.index_file))
+                db = sqlite3.connect(self.index_file, timeout=30)
+                with db:
+                    db.execute('CREATE TABLE IF NOT EXISTS packages ({}, PRIMARY KEY (catalog_url, url))'.format(', '.join('{} INTEGER'.format(column) if column == 'size' else '{} TEXT'.format(column) for column in self.columns)))
+                    db.execute('CREATE INDEX IF NOT EXISTS packages_product ON packages (product_id)')
+                    db.execute('CREATE INDEX IF NOT EXISTS packages_release ON packages (mac_os_ver, post_date)')
+                db.close()
+                self.created = True
+        db = sqlite3.connect(self.index_file, timeout=30)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def update(self, catalog_url, mac_os_ver, candidates):
+        '''Brings the packages indexed for a catalog up to date with its candidates from filterSUCatalog(). Packages that are new or'''
+        '''have a different PostDate are written without metadata, setMetadata() fills it in once it's resolved.'''
+        db = self.connect()
+        try:
+            with db:
+                indexed = dict((row['url'], (row['product_id'], row['post_date'])) for row in db.execute('SELECT url, product_id, post_date FROM packages WHERE catalog_url = ?', (catalog_url,)))
+                current = OrderedDict((candidate['url'], candidate) for candidate in candidates)
+                db.executemany('DELETE FROM packages WHERE catalog_url = ? AND url = ?', [(catalog_url, url) for url in indexed if url not in current])
+                db.executemany('INSERT OR REPLACE INTO packages ({}) VALUES ({})'.format(', '.join(self.columns[:10]), ', '.join('?' * 10)), [
+                    (catalog_url, mac_os_ver, candidate['product_id'], str(candidate['post_date']), url, os.path.basename(url), candidate.get('size'), candidate.get('digest'), candidate['smd_url'], candidate['pkm_url'])
+                    for url, candidate in current.items() if indexed.get(url) != (candidate['product_id'], str(candidate['post_date']))])
+        finally:
+            db.close()
+
+    def setMetadata(self, catalog_url, candidates, results):
+        '''Records the metadata resolved for candidates, results being in the same order as returned by resolveMetadata().'''
+        db = self.connect()
+        try:
+            with db:
+                db.executemany('UPDATE packages SET pkg_title = ?, version = ?, long_version = ?, pkg_identifier = ? WHERE catalog_url = ? AND url = ? AND (long_version IS NULL OR long_version != ?)', [
+                    (metadata['pkg_title'], metadata['pkg_version'], metadata['long_pkg_version'], metadata['pkg_identifier'], catalog_url, candidate['url'], metadata['long_pkg_version'])
+                    for candidate, metadata in zip(candidates, results)])
+        finally:
+            db.close()
+
+    def query(self, where='1', parameters=(), mac_os_vers=None):
+        '''Returns the indexed packages matching an SQL condition, newest first, optionally only for some macOS releases.'''
+        if mac_os_vers:
+            where = '({}) AND mac_os_ver IN ({})'.format(where, ', '.join('?' * len(mac_os_vers)))
+            parameters = tuple(parameters) + tuple(mac_os_vers)
+        if not os.path.exists(self.index_file):
+            return []
+        db = self.connect()
+        try:
+            # The same package may be indexed from more than one copy of a catalog, such as Apple's and a mirror's
+            return db.execute('SELECT DISTINCT {} FROM packages WHERE {} ORDER BY post_date DESC, mac_os_ver, product_id, pkg'.format(', '.join(self.columns[1:]), where), parameters).fetchall()
+        finally:
+            db.close()
 
 
 class XcodeCLI():
-    def __init__(self, allow_untrusted_pkg_install=False, catalog=False, destination=False, dry_run=False, install=False, install_target=False, mac_os_ver=False, quiet=False):
+    # Range of OS releases this tool supports
+    supported_os_versions = ['10.9', '10.10', '10.11', '10.12', '10.13', '10.14']
+
+    # Installer that is subject to the root and macOS release checks
+    system_installer = '/usr/sbin/installer'
+
+    # Bumped whenever the contents of cached catalogs change, so older caches are fetched again
+    catalog_cache_format = 2
+
+    # Where catalogs, metadata, packages and the catalog index are kept between runs
+    default_cache_dir = '~/Library/Caches/xcodetools'
+
+    def __init__(self, allow_untrusted_pkg_install=False, base_url=False, cache_dir=False, cache_max_age=False, catalog=False, changes_only=False, connections=False, destination=False, dry_run=False, incremental=False, index=None, index_file=False, install=False, install_target=False, installer=False, mac_os_ver=False, max_host_rate=False, max_rate=False, max_transfers=False, max_workers=False, metadata_cache=None, metadata_cache_size=False, metrics=None, no_cache=False, quiet=False, receipts_dir=False, reinstall=False, scheduler=None, store=None, store_dir=False, store_quota=False, timeout=False, transport=False):
         '''Initialise class XcodeTools() with various attributes.'''
         '''Attributes:'''
+        '''    base_url = send all requests to this scheme and host instead, such as a mirror or local test server'''
+        '''    cache_dir = override the folder path used to cache catalogs between runs'''
+        '''    cache_max_age = seconds a cached catalog is used for before it is revalidated with the server'''
         '''    catalog = override the catalog with your own catalog URL'''
+        '''    changes_only = only report products that are new, changed or removed since the last changes_only run'''
+        '''    connections = maximum number of concurrent byte range requests per package download'''
         '''    destination = override the download destination with your own folder path'''
         '''    dry_run = output to stdout what will be downloaded'''
+        '''    incremental = only resolve and download products that are new or changed since the last run'''
+        '''    index = share a CatalogIndex() with other instances'''
+        '''    index_file = override the file path of the catalog index used by list, search and show'''
         '''    install = install packages after they are downloaded'''
+        '''    installer = override the installer command, such as a stand-in script for testing'''
         '''    mac_os_ver = override the version of macOS you are downloading for'''
+        '''    max_host_rate = maximum bytes/sec fetched from any one host'''
+        '''    max_rate = maximum bytes/sec fetched across every transfer'''
+        '''    max_transfers = maximum number of catalog, metadata and package transfers open at once'''
+        '''    max_workers = maximum number of concurrent metadata requests'''
+        '''    metadata_cache = share a MetadataCache() with other instances'''
+        '''    metadata_cache_size = maximum number of SMD/PKM metadata entries kept in the cache'''
+        '''    metrics = share a Metrics() with other instances, to record phase timings, fetches and cache hits'''
+        '''    no_cache = always download the catalog and metadata in full and don't update the cache'''
         '''    quiet = suppresses stdout output'''
+        '''    receipts_dir = override the folder of installed package receipts checked before installing, defaults to var/db/receipts on the install target'''
+        '''    reinstall = install packages even if the receipts show the same or a newer version is already installed'''
+        '''    scheduler = share a TransferScheduler() with other instances, so their limits apply to every transfer between them'''
+        '''    store = share a PackageStore() with other instances'''
+        '''    store_dir = override the folder path packages are kept in between runs, defaults to a packages folder in the cache folder'''
+        '''    store_quota = maximum size in megabytes of the package store before least recently used packages are removed'''
+        '''    timeout = maximum time in seconds a single metadata request may take'''
+        '''    transport = 'http' (default) for pooled in process requests or 'curl', or a transport to share with other instances'''
         self.allow_untrusted_pkg_install = allow_untrusted_pkg_install
+        self.base_url = base_url
+        if cache_dir:
+            self.cache_dir = os.path.expandvars(os.path.expanduser(cache_dir))
+        else:
+            self.cache_dir = os.path.expanduser(self.default_cache_dir)
+        if cache_max_age:
+            self.cache_max_age = cache_max_age
+        else:
+            self.cache_max_age = 0
         self.catalog = catalog
+        self.changes_only = changes_only
+        if connections:
+            self.connections = connections
+        else:
+            self.connections = 4
         if destination:
             self.destination = os.path.expandvars(os.path.expanduser(destination))
         else:
             self.destination = '/tmp/xcode'
         self.dry_run = dry_run
+        self.incremental = incremental
         self.install = install
         if install_target:
             self.install_target = install_target
         else:
             self.install_target = '/'
+        if installer:
+            self.installer = installer
+        else:
+            self.installer = self.system_installer
         self.system_mac_os_ver = '.'.join(mac_ver()[0].split('.')[:2])  # Use this for install checks to avoid installing incorrect versions when overriding mac_os_ver
         if not mac_os_ver:
             # Only need the major OS release version to form the url - example: '10.13'
@@ -45,13 +1191,49 @@ class XcodeCLI():
         else:
             # Only need the major OS release version to form the url - example: '10.13'
             self.mac_os_ver = '.'.join(mac_os_ver.split('.')[:2])
+        if max_workers:
+            self.max_workers = max_workers
+        else:
+            self.max_workers = 8
+        self.no_cache = no_cache
         self.quiet = quiet
+        if receipts_dir:
+            self.receipts_dir = os.path.expandvars(os.path.expanduser(receipts_dir))
+        else:
+            self.receipts_dir = os.path.join(self.install_target, 'var/db/receipts')
+        self.reinstall = reinstall
+        if store_dir:
+            self.store_dir = os.path.expandvars(os.path.expanduser(store_dir))
+        else:
+            self.store_dir = os.path.join(self.cache_dir, 'packages')
+        if store_quota:
+            self.store_quota = store_quota
+        else:
+            self.store_quota = 10240
+        if timeout:
+            self.timeout = timeout
+        else:
+            self.timeout = 30
+        if metrics:
+            self.metrics = metrics
+        else:
+            self.metrics = Metrics()
+        if transport == 'curl':
+            self.transport = CurlTransport()
+        elif transport and transport != 'http':
+            self.transport = transport
+        else:
+            self.transport = HTTPTransport(metrics=self.metrics)
+        if scheduler:
+            self.scheduler = scheduler
+        else:
+            self.scheduler = TransferScheduler(max_rate=max_rate, max_host_rate=max_host_rate, max_transfers=max_transfers or 8, progress=not self.quiet, metrics=self.metrics)
 
         # Messages to use in dry run
         if self.dry_run:
-            self.download_msg, self.install_msg, self.cleanup_msg = 'Download', 'Install', 'Remove'
+            self.download_msg, self.install_msg, self.cleanup_msg, self.link_msg = 'Download', 'Install', 'Remove', 'Link'
         else:
-            self.download_msg, self.install_msg, self.cleanup_msg = 'Downloading', 'Installing', 'Removing'
+            self.download_msg, self.install_msg, self.cleanup_msg, self.link_msg = 'Downloading', 'Installing', 'Removing', 'Linking'
 
         # Construct a dictionary of known software update catalogs
         # Thanks to Pike: https://pikeralpha.wordpress.com/2017/06/06/catalogurl-for-macos-10-13-high-sierra/
@@ -67,9 +1249,6 @@ class XcodeCLI():
             'developerseed': 'seed',
         }
 
-        # Range of OS releases this tool supports
-        self.supported_os_versions = ['10.9', '10.10', '10.11', '10.12', '10.13', '10.14']
-
         # Xcode package names to check
         # Filename change in macOS 10.14 CL Tools. CLTools_SDK replaces DevSDK. Being explicit even tho CLTools will match
         self.pkg_names = ['CLTools', 'CLTools_SDK', 'DevSDK']
@@ -77,8 +1256,36 @@ class XcodeCLI():
         # SU Catalog URL to use
         self.sucatalog_url = self.swscanURL(self.mac_os_ver, self.catalog)
 
-        # Empty dictionary to store found packages
+        # Empty dictionary to store found packages, and the list of every package of interest they were chosen from
         self.packages_to_process = {}
+        self.candidates = []
+
+        # SMD/PKM metadata already parsed, shared by every package in a product and kept between runs unless caching is off
+        if not metadata_cache_size:
+            metadata_cache_size = 1024
+        if metadata_cache:
+            self.metadata_cache = metadata_cache
+        elif self.no_cache:
+            self.metadata_cache = MetadataCache(max_entries=metadata_cache_size)
+        else:
+            self.metadata_cache = MetadataCache(cache_file=os.path.join(self.cache_dir, 'metadata.plist'), max_entries=metadata_cache_size)
+
+        # Downloaded packages, which download names link to so they survive the destination being removed after an install
+        if store:
+            self.store = store
+        else:
+            self.store = PackageStore(self.store_dir, max_size=self.store_quota * 1024 * 1024)
+
+        # Every catalog fetched is recorded so it can be listed and searched later without fetching it again
+        if index:
+            self.index = index
+        elif index_file:
+            self.index = CatalogIndex(os.path.expandvars(os.path.expanduser(index_file)))
+        else:
+            self.index = CatalogIndex(os.path.join(self.cache_dir, 'index.sqlite'))
+
+        # Works out which packages actually need installing from the installed package receipts
+        self.install_planner = InstallPlanner(self.receipts_dir)
 
     def swscanURL(self, mac_os_ver, catalog=None):
         '''Returns a string containing the sucatalog URL path to be used to check for Xcode Tools. Do not call directly.'''
@@ -90,182 +1297,906 @@ class XcodeCLI():
         except Exception:
             raise
 
-    def processSUCatalog(self):
-        try:
-            if not self.quiet:
-                print 'Retrieving software catalog: {}'.format(self.sucatalog_url)
-            destination_file = os.path.join(self.destination, os.path.basename(self.sucatalog_url))
+    def filterSUCatalog(self, sucatalog_file):
+        '''Returns a list of the packages of interest in a sucatalog, read incrementally from an uncompressed file like object.'''
+        candidates = []
+        for product, details in self.iterSUCatalogProducts(sucatalog_file):
+            for item in details['Packages']:
+                if any(pkg_name in item['URL'] for pkg_name in self.pkg_names):
+                    candidate = {
+                        'distribution': details['Distributions']['English'],  # Not used in this tool presently, but may in future.
+                        'product_id': product,
+                        'post_date': details['PostDate'],
+                        'url': item['URL'],
+                        'smd_url': details['ServerMetadataURL'],
+                        'pkm_url': item['MetadataURL'],
+                    }
+                    # Used to verify downloads, not every package entry has them
+                    if 'Size' in item:
+                        candidate['size'] = item['Size']
+                    if 'Digest' in item:
+                        candidate['digest'] = item['Digest']
+                    candidates.append(candidate)
+        return candidates
+
+    def iterSUCatalogProducts(self, sucatalog_file):
+        '''Yields (product_id, product) for each product in a sucatalog. Only one product is held in memory at a time.'''
+        # Depth of elements in a sucatalog: <plist> 1, top level <dict> 2, 'Products' <dict> 3, each product <dict> 4
+        depth = 0
+        top_level_key = None
+        products = None
+        product_id = None
+        for event, element in ET.iterparse(sucatalog_file, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if depth == 3 and element.tag == 'dict' and top_level_key == 'Products':
+                    products = element
+                continue
+
+            if depth == 3 and element.tag == 'key':
+                top_level_key = element.text
+            elif depth == 3 and element is products:
+                products = None
+            elif depth == 4 and products is not None:
+                if element.tag == 'key':
+                    product_id = element.text
+                else:
+                    product = plistElementToObject(element)
+                    # Discard the parsed elements so the tree doesn't grow with the catalog
+                    products.clear()
+                    yield product_id, product
+            depth -= 1
+
+    def catalogCacheFile(self):
+        '''Returns the path of the file used to cache the current sucatalog URL. Do not call directly.'''
+        return os.path.join(self.cache_dir, 'catalogs', '{}.plist'.format(hashlib.sha1(self.rewriteURL(self.sucatalog_url)).hexdigest()))
+
+    def readCatalogCache(self):
+        '''Returns the cached filtered catalog for the current sucatalog URL, or None if there isn't a usable one.'''
+        if self.no_cache:
+            return None
+        try:
+            cache = plistlib.readPlist(self.catalogCacheFile())
+        except Exception:
+            return None
+        # The cached result only holds packages matching pkg_names, so can't be reused if those change
+        if cache.get('format') != self.catalog_cache_format or cache.get('url') != self.rewriteURL(self.sucatalog_url) or cache.get('pkg_names') != self.pkg_names:
+            return None
+        return cache
+
+    def writeCatalogCache(self, cache):
+        if self.no_cache:
+            return
+        cache_file = self.catalogCacheFile()
+        makeDirs(os.path.dirname(cache_file))
+        # Write to a temporary file first so an interrupted run can't leave a truncated cache behind
+        plistlib.writePlist(cache, '{}.tmp'.format(cache_file))
+        os.rename('{}.tmp'.format(cache_file), cache_file)
+
+    def productIndexFile(self):
+        '''Returns the path of the file recording the products seen in the current sucatalog on the last run. Do not call directly.'''
+        '''Runs with changes_only keep their own, so a monitoring job doesn't use up the changes an incremental download is waiting for.'''
+        return os.path.join(self.cache_dir, 'products', '{}{}.plist'.format(hashlib.sha1(self.rewriteURL(self.sucatalog_url)).hexdigest(), '.changes' if self.changes_only else ''))
+
+    def diffProducts(self, candidates):
+        '''Compares the products with packages of interest against those recorded on the last run, storing the product IDs that are'''
+        '''new, changed (different PostDate or package URLs) or removed in catalog_changes. saveProductIndex() records the current ones.'''
+        self.current_products = {}
+        for candidate in candidates:
+            product = self.current_products.setdefault(candidate['product_id'], {'post_date': candidate['post_date'], 'urls': []})
+            product['urls'] = sorted(product['urls'] + [candidate['url']])
+
+        try:
+            previous_products = plistlib.readPlist(self.productIndexFile())['products']
+        except Exception:
+            previous_products = {}
+
+        self.catalog_changes = {
+            'new': sorted(product for product in self.current_products if product not in previous_products),
+            'changed': sorted(product for product in self.current_products if product in previous_products and previous_products[product] != self.current_products[product]),
+            'removed': sorted(product for product in previous_products if product not in self.current_products),
+        }
+
+    def saveProductIndex(self):
+        index_file = self.productIndexFile()
+        makeDirs(os.path.dirname(index_file))
+        plistlib.writePlist({'url': self.rewriteURL(self.sucatalog_url), 'products': self.current_products}, '{}.tmp'.format(index_file))
+        os.rename('{}.tmp'.format(index_file), index_file)
+
+    def printChanges(self):
+        changes = self.catalog_changes
+        if not any(changes.values()):
+            self.scheduler.write('macOS {}: no changes since last run'.format(self.mac_os_ver))
+            return
+        self.scheduler.write('macOS {}: {} new, {} changed, {} removed product(s)'.format(self.mac_os_ver, len(changes['new']), len(changes['changed']), len(changes['removed'])))
+        for change in ['new', 'changed']:
+            for product in changes[change]:
+                self.scheduler.write('    {} {} posted {}: {}'.format(change, product, self.current_products[product]['post_date'], ', '.join(os.path.basename(url) for url in self.current_products[product]['urls'])))
+        for product in changes['removed']:
+            self.scheduler.write('    removed {}'.format(product))
+
+    def processSUCatalog(self):
+        try:
+            with self.metrics.phase('processSUCatalog'):
+                self.packages_to_process = {}
+                cache = self.readCatalogCache()
+
+                with self.metrics.phase('catalog'):
+                    if cache and (datetime.utcnow() - cache['checked']).total_seconds() < self.cache_max_age:
+                        if not self.quiet:
+                            self.scheduler.write('Using cached software catalog: {}'.format(self.rewriteURL(self.sucatalog_url)))
+                        self.metrics.count('catalog_cache_fresh')
+                        candidates = cache['candidates']
+                    else:
+                        if not self.quiet:
+                            self.scheduler.write('Retrieving software catalog: {}'.format(self.rewriteURL(self.sucatalog_url)))
+
+                        # Revalidate any cached copy rather than downloading the catalog again
+                        request_headers = []
+                        if cache and cache.get('etag'):
+                            request_headers.append('If-None-Match: {}'.format(cache['etag']))
+                        if cache and cache.get('last_modified'):
+                            request_headers.append('If-Modified-Since: {}'.format(cache['last_modified']))
+
+                        # Stream the sucatalog, decompressing and parsing it as it arrives rather than saving it to disk first
+                        response = self.openURL(self.sucatalog_url, headers=request_headers, kind='catalog')
+                        try:
+                            if response.status == 304:
+                                if not self.quiet:
+                                    self.scheduler.write('Software catalog not modified since {}'.format(cache['checked']))
+                                self.metrics.count('catalog_not_modified')
+                                candidates = cache['candidates']
+                            else:
+                                # Iterate, yo. Collect the matching packages first, their metadata is resolved concurrently.
+                                candidates = self.filterSUCatalog(GzipStream(response))
+                        finally:
+                            response.close()
+
+                        if response.status != 304:
+                            cache = {'format': self.catalog_cache_format, 'url': self.rewriteURL(self.sucatalog_url), 'pkg_names': self.pkg_names, 'candidates': candidates}
+                            if response.headers.get('etag'):
+                                cache['etag'] = response.headers['etag']
+                            if response.headers.get('last-modified'):
+                                cache['last_modified'] = response.headers['last-modified']
+
+                        cache['checked'] = datetime.utcnow()
+                        self.writeCatalogCache(cache)
+
+                self.candidates = candidates
+                self.diffProducts(candidates)
+                with self.metrics.phase('index'):
+                    self.index.update(self.rewriteURL(self.sucatalog_url), self.mac_os_ver, candidates)
+                if self.changes_only:
+                    return
+                if self.incremental:
+                    candidates = [candidate for candidate in candidates if candidate['product_id'] in self.catalog_changes['new'] + self.catalog_changes['changed']]
+
+                with self.metrics.phase('metadata'):
+                    results = self.resolveMetadata(candidates)
+                with self.metrics.phase('index'):
+                    self.index.setMetadata(self.rewriteURL(self.sucatalog_url), candidates, results)
+
+                with self.metrics.phase('selection'):
+                    # Results are merged in catalog order so the outcome doesn't depend on which request finished first.
+                    for candidate, metadata in zip(candidates, results):
+                        basename = os.path.basename(candidate['url'])
+                        pkg_ver = metadata['pkg_version']
+                        long_pkg_ver = metadata['long_pkg_version']
+                        pkg_id = metadata['pkg_identifier']
+                        pkg_title = metadata['pkg_title']
+                        # Change the destination filename so it's clear what version of macOS and what version of CL tools.
+                        pkg_download_name = os.path.join(self.destination, basename.replace('.pkg', '_macOS_{}-{}.pkg'.format(self.mac_os_ver, '.'.join(long_pkg_ver.split('.')[:3]))))
+
+                        # Test if combo already exists in dictionary and if so, version comparison test to make sure only latest version gets added
+                        if basename not in self.packages_to_process.keys() or LooseVersion(long_pkg_ver) > LooseVersion(self.packages_to_process[basename]['long_version']):
+                            self.packages_to_process[basename] = {'distribution': candidate['distribution'], 'product_id': candidate['product_id'], 'pkg_title': pkg_title, 'pkg': basename, 'url': candidate['url'], 'post_date': candidate['post_date'], 'version': pkg_ver, 'long_version': long_pkg_ver, 'pkg_identifier': pkg_id, 'download_name': pkg_download_name, 'size': candidate.get('size'), 'digest': candidate.get('digest')}
+        except Exception:
+            raise
+
+    def resolveMetadata(self, candidates):
+        '''Returns a list of metadata dictionaries, one per candidate and in the same order, fetched by a bounded pool of workers.'''
+        # Each SMD/PKM is fetched at most once no matter how many packages share it, and not at all if it's cached
+        resolved, fetches = {}, []
+        for candidate in candidates:
+            for fetch in [(self.fetchServerMetadata, candidate['smd_url']), (self.fetchPackageMetadata, candidate['pkm_url'])]:
+                if fetch[1] in resolved or fetch in fetches:
+                    continue
+                metadata = self.metadata_cache.get(fetch[1])
+                if metadata is None:
+                    self.metrics.count('metadata_cache_misses')
+                    fetches.append(fetch)
+                else:
+                    self.metrics.count('metadata_cache_hits')
+                    resolved[fetch[1]] = metadata
+
+        if fetches:
+            resolved.update(zip([fetch[1] for fetch in fetches], poolMap(lambda fetch: fetch[0](fetch[1]), fetches, min(self.max_workers, len(fetches)))))
+        self.metadata_cache.save()
+
+        results = []
+        for candidate in candidates:
+            metadata = dict(resolved[candidate['smd_url']])
+            metadata.update(resolved[candidate['pkm_url']])
+            results.append(metadata)
+        return results
+
+    def fetchServerMetadata(self, smd_url):
+        '''Returns the package version and title from a ServerMetadataURL, using the cached copy if there is one.'''
+        metadata = self.metadata_cache.get(smd_url)
+        if metadata is None:
+            smd = plistlib.readPlist(self.fetchMetadataFile(smd_url))
+            metadata = {'pkg_version': smd['CFBundleShortVersionString'], 'pkg_title': smd['localization']['English']['title']}
+            self.metadata_cache.set(smd_url, metadata)
+        return metadata
+
+    def fetchPackageMetadata(self, pkm_url):
+        '''Returns the long package version and identifier from a PKM MetadataURL, using the cached copy if there is one.'''
+        metadata = self.metadata_cache.get(pkm_url)
+        if metadata is None:
+            meta_root = ET.parse(self.fetchMetadataFile(pkm_url)).getroot()
+            metadata = {'long_pkg_version': meta_root.attrib['version'], 'pkg_identifier': meta_root.attrib['identifier']}
+            self.metadata_cache.set(pkm_url, metadata)
+        return metadata
+
+    def fetchMetadataFile(self, url):
+        '''Returns a file like object with the contents of a metadata URL, held in memory as these are small.'''
+        return StringIO(self.openURL(url, timeout=self.timeout, kind='metadata').read())
+
+    def rewriteURL(self, url):
+        '''Returns the URL with its scheme and host replaced by base_url, if one was given, so requests can go to a mirror or test server.'''
+        if not self.base_url:
+            return url
+        parts = urlparse.urlsplit(url)
+        return self.base_url.rstrip('/') + urlparse.urlunsplit(('', '', parts.path, parts.query, parts.fragment))
+
+    def openURL(self, input_file, headers=None, timeout=None, kind='package'):
+        '''Returns a response for a URL from the transport in use, with the body available to read as it arrives.'''
+        '''The fetch is recorded in the metrics as kind, one of catalog, metadata or package, and waits its turn with the scheduler.'''
+        url = self.rewriteURL(input_file)
+        self.scheduler.acquire(self.scheduler.priority(kind, url))
+        started = time.time()
+        try:
+            response = self.transport.open(url, headers=headers, timeout=timeout)
+        except Exception as e:
+            self.metrics.fetch(kind, input_file, started, None, 0, error=str(e))
+            self.scheduler.release()
+            raise
+        return MeteredResponse(response, self.metrics, kind, input_file, started, scheduler=self.scheduler, host=urlparse.urlsplit(url).netloc)
+
+    def download(self, input_file, output_file, size=None, digest=None):
+        '''Downloads a URL to a file as concurrent byte range segments, resuming any earlier partial download.'''
+        '''The size and digest are verified as it downloads if they are known.'''
+        SegmentedDownload(input_file, output_file, open_url=self.openURL, size=size, digest=digest, connections=self.connections, metrics=self.metrics).run()
+
+    def installPkg(self, package):
+        cmd = [self.installer, '-pkg', package]
+        if self.allow_untrusted_pkg_install:
+            cmd.extend(['--allowUntrusted'])
+        cmd.extend(['-target', self.install_target])
+
+        if not self.dry_run:
+            # A stand-in installer can't do any harm, so only the real one is held to the macOS release check
+            if self.installer != self.system_installer or LooseVersion(self.system_mac_os_ver) == LooseVersion(self.mac_os_ver):
+                with self.metrics.phase('install'):
+                    self.scheduler.write('{} {}'.format(self.install_msg, package))
+                    (result, error) = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
+
+                    result_msg = 'install finished without reporting a result, see /var/log/install.log'
+                    if 'successful' in result:
+                        result_msg = 'install successful'
+                    if 'upgrade' in result:
+                        result_msg = 'upgrade successful'
+                    if error or any(x in result.lower() for x in ['fail', 'failed']):
+                        result_msg = 'install/upgrade failed, see /var/log/install.log'
+
+                self.scheduler.write('{} {}'.format(package, result_msg))
+            else:
+                self.scheduler.write('Not a good idea to try and install macOS {} CL tools on macOS {}'.format(self.mac_os_ver, self.system_mac_os_ver))
+                self.scheduler.write('Downloaded files can be found in {}'.format(self.destination))
+                sys.exit(1)
+
+    def downloadPkg(self, package):
+        '''Downloads a package found by processSUCatalog() into the package store, unless it is already there, and links its download name to it.'''
+        if self.store.contains(package['url'], package['digest']):
+            self.metrics.count('package_store_hits')
+            self.linkPkg(package)
+            return
+        self.metrics.count('package_store_misses')
+        with self.metrics.phase('download'):
+            if not self.quiet and not os.path.exists(package['download_name']):
+                self.scheduler.write('{} {} - {} (version {} released {}) to {}'.format(self.download_msg, package['product_id'], package['pkg_title'], package['version'], package['post_date'], package['download_name']))
+            if not self.dry_run:
+                self.store.link(self.store.fetch(package['url'], self.download, size=package['size'], digest=package['digest']), package['download_name'])
+
+    def downloadPkgs(self, packages):
+        '''Downloads packages concurrently, leaving the scheduler to decide which transfers go first. A dry run goes through them in order.'''
+        if self.dry_run or len(packages) < 2:
+            for package in packages:
+                self.downloadPkg(package)
+            return
+        poolMap(self.downloadPkg, packages, min(self.scheduler.max_transfers, len(packages)))
+
+    def linkPkg(self, package):
+        '''Links the download name of a package to its copy in the package store, fetching it again if it has been removed since.'''
+        with self.metrics.phase('link'):
+            if not self.quiet and not os.path.exists(package['download_name']):
+                self.scheduler.write('{} {} to {}'.format(self.link_msg, self.store.path(package['url'], package['digest']), package['download_name']))
+            if not self.dry_run:
+                self.store.link(self.store.fetch(package['url'], self.download, size=package['size'], digest=package['digest']), package['download_name'])
+
+    def planInstall(self, install_order):
+        '''Returns the packages in install_order that need installing, leaving out those the receipts show are already up to date'''
+        '''unless reinstalling, and prints the plan.'''
+        plan = self.install_planner.plan([self.packages_to_process[pkg] for pkg in install_order])
+        if not self.quiet:
+            self.scheduler.write('Install plan for macOS {}:'.format(self.mac_os_ver))
+            for package, action, installed_version in plan:
+                if action == 'install':
+                    self.scheduler.write('    install {} {} ({})'.format(package['pkg_identifier'], package['long_version'], package['pkg']))
+                elif action == 'upgrade':
+                    self.scheduler.write('    upgrade {} {} to {} ({})'.format(package['pkg_identifier'], installed_version, package['long_version'], package['pkg']))
+                else:
+                    self.scheduler.write('    {} {} {} is installed ({})'.format('reinstall' if self.reinstall else 'skip', package['pkg_identifier'], installed_version, package['pkg']))
+        if self.reinstall:
+            return install_order
+        return [package['pkg'] for package, action, _ in plan if action != 'skip']
+
+    def pipelineInstall(self, install_order):
+        '''Downloads packages concurrently in the background and installs each one in install order as soon as it and every package before'''
+        '''it have arrived, so the network and the installer are kept busy at the same time. The scheduler decides which transfers go first,'''
+        '''the same order as install_order. Prints how long each package took and how much of its install overlapped downloads.'''
+        timings = dict((pkg, {}) for pkg in install_order)
+        downloaded = Queue.Queue()
+
+        def download(pkg):
+            timings[pkg]['download_start'] = time.time()
+            try:
+                self.downloadPkg(self.packages_to_process[pkg])
+            except Exception as e:
+                downloaded.put((pkg, e))
+                return
+            timings[pkg]['download_end'] = time.time()
+            downloaded.put((pkg, None))
+
+        pool = ThreadPool(min(self.scheduler.max_transfers, len(install_order)))
+        for pkg in install_order:
+            pool.apply_async(download, (pkg,))
+        pool.close()
+
+        # Downloads finish in any order, so each package waits for its own. Any that fail are only raised once it's their turn to install
+        finished = {}
+        try:
+            for pkg in install_order:
+                while pkg not in finished:
+                    # A get() without a timeout can't be interrupted on Python 2
+                    try:
+                        done, error = downloaded.get(timeout=0.5)
+                        finished[done] = error
+                    except Queue.Empty:
+                        pass
+                if finished[pkg]:
+                    raise finished[pkg]
+                timings[pkg]['install_start'] = time.time()
+                self.installPkg(self.packages_to_process[pkg]['download_name'])
+                timings[pkg]['install_end'] = time.time()
+        except BaseException:
+            # Downloads still running are abandoned, the pool's threads are daemons
+            pool.terminate()
+            raise
+        pool.join()
+
+        if not self.quiet:
+            downloads_end = max(timings[pkg]['download_end'] for pkg in install_order)
+            for pkg in install_order:
+                overlap = max(0, min(timings[pkg]['install_end'], downloads_end) - timings[pkg]['install_start'])
+                self.scheduler.write('{}: downloaded in {:.1f}s, installed in {:.1f}s, {:.1f}s of the install overlapped downloads'.format(
+                    pkg, timings[pkg]['download_end'] - timings[pkg]['download_start'], timings[pkg]['install_end'] - timings[pkg]['install_start'], overlap))
+
+    def mainProcessor(self):
+        # Only the real installer needs root, a stand-in may be used for testing
+        if self.install and self.installer == self.system_installer and os.getuid() is not 0:
+            self.scheduler.write('Must be root to install packages.')
+            sys.exit(1)
+
+        with self.metrics.phase('mainProcessor'):
+            self.processSUCatalog()
+
+            if self.changes_only:
+                self.printChanges()
+                self.saveProductIndex()
+                return
+
+            # Note, not all catalogs contain the downloads once GM's are released
+            if not self.packages_to_process:
+                if self.incremental:
+                    self.saveProductIndex()
+                    self.scheduler.write('No new or changed Command Line Tool downloads since last run')
+                else:
+                    self.scheduler.write('No Command Line Tool downloads found')
+                sys.exit(0)
+
+            # There are packages that remove older SDK's, these may need to be installed first. The rest go in the order the scheduler
+            # fetches them, the CLTools ahead of the bigger SDKs
+            install_order = sorted(self.packages_to_process, key=lambda pkg: (self.scheduler.priority('package', self.packages_to_process[pkg]['url']), pkg))
+
+            # Packages that are already installed at the same or a newer version aren't downloaded or installed again
+            if self.install:
+                install_order = self.planInstall(install_order)
+                if not install_order and not self.quiet:
+                    self.scheduler.write('Command Line Tool packages are already up to date, nothing to install')
+
+            if self.install and not self.dry_run:
+                if install_order:
+                    self.pipelineInstall(install_order)
+            else:
+                self.downloadPkgs([self.packages_to_process[pkg] for pkg in install_order])
+
+                if self.install:
+                    for pkg in install_order:
+                        self.scheduler.write('{} {}'.format(self.install_msg, self.packages_to_process[pkg]['download_name']))
+
+            # Products are only recorded as seen once they have been dealt with
+            if not self.dry_run:
+                self.saveProductIndex()
+
+            if self.install and os.path.exists(self.destination):
+                try:
+                    if not self.quiet:
+                        self.scheduler.write('{} {}'.format(self.cleanup_msg, self.destination))
+                    # Only the download names go, the packages stay in the store for the next run
+                    shutil.rmtree(self.destination)
+                except Exception:
+                    raise
+
+
+class XcodeCLIGroup():
+    '''Downloads the Xcode CLI tools for several macOS releases in one run. Packages shared by releases are only downloaded once.'''
+    def __init__(self, mac_os_vers, **kwargs):
+        '''Initialise class XcodeCLIGroup() with an XcodeCLI() for each release in mac_os_vers, which may include 'all'.'''
+        '''Any other keyword arguments are passed on to XcodeCLI().'''
+        if 'all' in mac_os_vers:
+            mac_os_vers = XcodeCLI.supported_os_versions
+
+        # Releases share a metadata cache, package store and connections as most of their packages come from the same products, and
+        # a scheduler so the transfer and rate limits apply to the run as a whole
+        self.members = []
+        for mac_os_ver in mac_os_vers:
+            if self.members:
+                kwargs['index'] = self.members[0].index
+                kwargs['metadata_cache'] = self.members[0].metadata_cache
+                kwargs['metrics'] = self.members[0].metrics
+                kwargs['scheduler'] = self.members[0].scheduler
+                kwargs['store'] = self.members[0].store
+                kwargs['transport'] = self.members[0].transport
+            self.members.append(XcodeCLI(mac_os_ver=mac_os_ver, **kwargs))
+        self.metrics = self.members[0].metrics
+        self.scheduler = self.members[0].scheduler
+
+    def processSUCatalogs(self):
+        '''Fetches and processes the catalog for each release concurrently.'''
+        poolMap(lambda member: member.processSUCatalog(), self.members, len(self.members))
+
+    def mainProcessor(self):
+        with self.metrics.phase('mainProcessor'):
+            self.processSUCatalogs()
+
+            if self.members[0].changes_only:
+                for member in self.members:
+                    member.printChanges()
+                    member.saveProductIndex()
+                return
+
+            # Group packages by where they are stored, their digest or else their URL, so each one is only downloaded once no matter how many
+            # releases or products it is in
+            downloads = OrderedDict()
+            for member in self.members:
+                for pkg in member.packages_to_process.values():
+                    downloads.setdefault(member.store.key(pkg['url'], pkg['digest']), []).append((member, pkg))
+
+            if not downloads:
+                if self.members[0].incremental:
+                    for member in self.members:
+                        member.saveProductIndex()
+                    self.scheduler.write('No new or changed Command Line Tool downloads since last run')
+                else:
+                    self.scheduler.write('No Command Line Tool downloads found')
+                sys.exit(0)
+
+            def download(packages):
+                member, source = packages[0]
+                member.downloadPkg(source)
+                for member, pkg in packages[1:]:
+                    member.linkPkg(pkg)
+
+            # Downloaded concurrently in priority order, the scheduler decides which transfers go first
+            ordered = sorted(downloads.values(), key=lambda packages: (self.scheduler.priority('package', packages[0][1]['url']), packages[0][1]['pkg']))
+            if self.members[0].dry_run:
+                for packages in ordered:
+                    download(packages)
+            else:
+                poolMap(download, ordered, min(self.scheduler.max_transfers, len(ordered)))
+
+            # Products are only recorded as seen once they have been dealt with
+            for member in self.members:
+                if not member.dry_run:
+                    member.saveProductIndex()
+
+
+def sendFile(sock, fileobj, offset, count):
+    '''Sends count bytes of a file, starting at offset, to a socket. Uses the sendfile() system call so the data goes straight from the'''
+    '''page cache to the socket without being copied through Python, falling back to reading and writing where it isn't available.'''
+    sent = 0
+    if sendfile_call is not None:
+        while sent < count:
+            if sys.platform == 'darwin':
+                length = ctypes.c_int64(count - sent)
+                result = sendfile_call(fileobj.fileno(), sock.fileno(), ctypes.c_int64(offset + sent), ctypes.byref(length), None, 0)
+                written = length.value
+            else:
+                position = ctypes.c_int64(offset + sent)
+                result = sendfile_call(sock.fileno(), fileobj.fileno(), ctypes.byref(position), ctypes.c_size_t(count - sent))
+                written = max(result, 0)
+            if result < 0 and ctypes.get_errno() not in [errno.EINTR, errno.EAGAIN]:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            if result >= 0 and written == 0:
+                break
+            sent += written
+        return sent
+
+    fileobj.seek(offset)
+    while sent < count:
+        data = fileobj.read(min(1048576, count - sent))
+        if not data:
+            break
+        sock.sendall(data)
+        sent += len(data)
+    return sent
+
+
+class MirrorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves files from the mirror folder with support for conditional and byte range requests.'''
+    protocol_version = 'HTTP/1.1'
+    server_version = 'xcodetools'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        path = self.server.mirrorFile(urllib.unquote(urlparse.urlsplit(self.path).path))
+        if not path:
+            self.sendEmpty(404)
+            return
+
+        with open(path, 'rb') as served_file:
+            stat = os.fstat(served_file.fileno())
+            etag = '"{:x}-{:x}"'.format(stat.st_size, int(stat.st_mtime))
+            last_modified = self.date_time_string(int(stat.st_mtime))
+            if self.headers.get('If-None-Match') == etag or (not self.headers.get('If-None-Match') and self.headers.get('If-Modified-Since') == last_modified):
+                self.sendEmpty(304, [('ETag', etag), ('Last-Modified', last_modified)])
+                return
+
+            start, end = 0, stat.st_size - 1
+            status, headers = 200, []
+            byte_range = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', '').strip())
+            if byte_range and (byte_range.group(1) or byte_range.group(2)):
+                if byte_range.group(1):
+                    start = int(byte_range.group(1))
+                    if byte_range.group(2):
+                        end = min(int(byte_range.group(2)), stat.st_size - 1)
+                else:
+                    start = max(0, stat.st_size - int(byte_range.group(2)))
+                if start > end:
+                    self.sendEmpty(416, [('Content-Range', 'bytes */{}'.format(stat.st_size))])
+                    return
+                status = 206
+                headers.append(('Content-Range', 'bytes {}-{}/{}'.format(start, end, stat.st_size)))
+
+            self.send_response(status)
+            for name, value in headers + [('Accept-Ranges', 'bytes'), ('Content-Type', 'application/octet-stream'), ('ETag', etag), ('Last-Modified', last_modified), ('Content-Length', str(end - start + 1))]:
+                self.send_header(name, value)
+            self.end_headers()
+            if not head:
+                self.wfile.flush()
+                self.sendBody(served_file, start, end - start + 1)
+
+    def sendBody(self, served_file, offset, count):
+        sendFile(self.connection, served_file, offset, count)
+
+    def sendEmpty(self, status, headers=None):
+        self.send_response(status)
+        for name, value in headers or []:
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class MirrorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''HTTP server for the mirror folder, handling each client connection in its own thread.'''
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, mirror_dir, quiet=False):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, MirrorRequestHandler)
+        self.mirror_dir = os.path.realpath(mirror_dir)
+        self.quiet = quiet
+
+    def mirrorFile(self, path):
+        '''Returns the file in the mirror folder for a request path, or None if there isn't one or it's a partial download or record.'''
+        served_file = os.path.realpath(os.path.join(self.mirror_dir, posixpath.normpath(path).lstrip('/')))
+        if not served_file.startswith(self.mirror_dir + os.sep) or not os.path.isfile(served_file):
+            return None
+        if any(served_file.endswith(suffix) for suffix in ['.part', '.part.plist', '.part.plist.tmp', '.verified', '.tmp']):
+            return None
+        return served_file
+
+
+class XcodeCLIMirror():
+    '''Mirrors the Xcode CLI tools for one or more macOS releases and serves them over HTTP, so a whole site can fetch them from one place.'''
+    '''Each release gets a filtered sucatalog at the same path as Apple's, holding only the products that would be downloaded, with its'''
+    '''URLs rewritten to the mirror. Clients point at it with --base-url.'''
+    def __init__(self, mac_os_vers, listen=False, mirror_dir=False, mirror_url=False, **kwargs):
+        '''Initialise class XcodeCLIMirror() with an XcodeCLIGroup() for mac_os_vers. Any other keyword arguments are passed on to it.'''
+        '''Attributes:'''
+        '''    listen = host:port to serve on, defaults to 0.0.0.0:8088'''
+        '''    mirror_dir = folder the mirrored files are kept in, defaults to a mirror folder in the cache folder'''
+        '''    mirror_url = URL clients reach the mirror at, used in the rewritten catalogs. Defaults to http://<this host>:<port>'''
+        self.group = XcodeCLIGroup(mac_os_vers, **kwargs)
+        self.metrics = self.group.metrics
+        self.scheduler = self.group.scheduler
+        self.quiet = self.group.members[0].quiet
+        host, _, port = (listen or '0.0.0.0:8088').rpartition(':')
+        self.listen = (host or '0.0.0.0', int(port))
+        if mirror_dir:
+            self.mirror_dir = os.path.expandvars(os.path.expanduser(mirror_dir))
+        else:
+            self.mirror_dir = os.path.join(self.group.members[0].cache_dir, 'mirror')
+        if mirror_url:
+            self.mirror_url = mirror_url.rstrip('/')
+        else:
+            self.mirror_url = 'http://{}:{}'.format(socket.getfqdn() if self.listen[0] == '0.0.0.0' else self.listen[0], self.listen[1])
+
+    def mirrorPath(self, url):
+        return os.path.join(self.mirror_dir, urlparse.urlsplit(url).path.lstrip('/'))
+
+    def mirrorURL(self, url):
+        parts = urlparse.urlsplit(url)
+        return self.mirror_url + urlparse.urlunsplit(('', '', parts.path, parts.query, parts.fragment))
+
+    def writeFile(self, path, data):
+        makeDirs(os.path.dirname(path))
+        with open('{}.tmp'.format(path), 'wb') as mirror_file:
+            mirror_file.write(data)
+        os.rename('{}.tmp'.format(path), path)
+
+    def buildMirror(self):
+        '''Resolves each release's catalog and copies the packages and metadata it needs into the mirror folder.'''
+        with self.metrics.phase('buildMirror'):
+            self.group.processSUCatalogs()
+            mirrored = set()
+            for member in self.group.members:
+                # Only the packages that would be downloaded are needed, the filtered catalog gives clients the same result
+                selected = set(pkg['url'] for pkg in member.packages_to_process.values())
+                products = {}
+                for candidate in member.candidates:
+                    if candidate['url'] not in selected:
+                        continue
+                    product = products.setdefault(candidate['product_id'], {
+                        'Distributions': {'English': candidate['distribution']},
+                        'Packages': [],
+                        'PostDate': candidate['post_date'],
+                        'ServerMetadataURL': self.mirrorURL(candidate['smd_url']),
+                    })
+                    package = {'URL': self.mirrorURL(candidate['url']), 'MetadataURL': self.mirrorURL(candidate['pkm_url'])}
+                    if candidate.get('size') is not None:
+                        package['Size'] = candidate['size']
+                    if candidate.get('digest'):
+                        package['Digest'] = candidate['digest']
+                    product['Packages'].append(package)
+
+                    for url in [candidate['smd_url'], candidate['pkm_url']]:
+                        if url not in mirrored:
+                            self.writeFile(self.mirrorPath(url), member.openURL(url, timeout=member.timeout, kind='metadata').read())
+                            mirrored.add(url)
+                    if candidate['url'] not in mirrored:
+                        if not self.quiet:
+                            self.scheduler.write('Mirroring {} - {}'.format(candidate['product_id'], candidate['url']))
+                        member.store.link(member.store.fetch(candidate['url'], member.download, size=candidate.get('size'), digest=candidate.get('digest')), self.mirrorPath(candidate['url']))
+                        mirrored.add(candidate['url'])
+
+                catalog = StringIO()
+                with gzip.GzipFile(fileobj=catalog, mode='wb') as sucatalog_file:
+                    sucatalog_file.write(plistlib.writePlistToString({'CatalogVersion': 2, 'Products': products}))
+                self.writeFile(self.mirrorPath(member.sucatalog_url), catalog.getvalue())
+                if not self.quiet:
+                    self.scheduler.write('Mirrored catalog for macOS {} with {} product(s): {}'.format(member.mac_os_ver, len(products), self.mirrorURL(member.sucatalog_url)))
+
+    def mainProcessor(self):
+        self.buildMirror()
+        server = MirrorServer(self.listen, self.mirror_dir, quiet=self.quiet)
+        if not self.quiet:
+            self.scheduler.write('Serving {} on {}:{} as {}'.format(self.mirror_dir, self.listen[0], self.listen[1], self.mirror_url))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+class XcodeCLIWatcher():
+    '''Polls the catalogs for one or more macOS releases, each on its own schedule, keeping a warm XcodeCLI() per release so'''
+    '''connections, cached catalogs and metadata carry over between polls. A JSON event is written to stdout, and optionally appended'''
+    '''to a file, when a package with a newer long_version than last seen appears. New packages can be downloaded straight away.'''
+    # Polls are spread by up to this fraction of the interval so a fleet doesn't poll in step
+    jitter = 0.1
+
+    # Seconds before the first retry after a failed poll, doubling with each failure up to the interval
+    min_backoff = 30
+
+    def __init__(self, mac_os_vers, events_out=False, interval=False, metrics_out=False, prestage=False, **kwargs):
+        '''Initialise class XcodeCLIWatcher() with an XcodeCLIGroup() for mac_os_vers. Any other keyword arguments are passed on to it.'''
+        '''Attributes:'''
+        '''    events_out = file to append each event to as a line of JSON, as well as writing it to stdout'''
+        '''    interval = seconds between polls of each catalog, defaults to 3600'''
+        '''    metrics_out = file to write the metrics to after every poll'''
+        '''    prestage = download new packages as soon as they appear, so they are ready in the destination'''
+        # stdout is kept for events
+        kwargs['quiet'] = True
+        self.group = XcodeCLIGroup(mac_os_vers, **kwargs)
+        self.metrics = self.group.metrics
+        self.scheduler = self.group.scheduler
+        if events_out:
+            self.events_out = os.path.expandvars(os.path.expanduser(events_out))
+        else:
+            self.events_out = False
+        if interval:
+            self.interval = interval
+        else:
+            self.interval = 3600
+        self.metrics_out = metrics_out
+        self.prestage = prestage
+
+        # Latest long_version seen of each package for each release, None until its catalog has been polled once
+        self.versions = dict((member.mac_os_ver, None) for member in self.group.members)
 
-            # Try and remove any existing sucatalog file
-            try:
-                os.remove(destination_file)
-            except:
-                pass
+    def emit(self, event, **fields):
+        fields.update({'event': event, 'time': datetime.utcnow().isoformat() + 'Z'})
+        line = json.dumps(fields, sort_keys=True, default=str)
+        self.scheduler.write(line)
+        if self.events_out:
+            with open(self.events_out, 'a') as events_file:
+                events_file.write(line + '\n')
 
-            # Download the sucatalog
-            self.curl(self.sucatalog_url, destination_file, quiet=True)
-
-            # Read in the GZ file with gzip
-            with gzip.open(destination_file, 'rb') as sucatalog_file:
-                catalog = sucatalog_file.read()
-
-            # Process the catalog file into a dictionary
-            catalog = plistlib.readPlistFromString(catalog)
-
-            # Iterate, yo.
-            for product in catalog['Products']:
-                packages = catalog['Products'][product]['Packages']
-                post_date = catalog['Products'][product]['PostDate']
-                for item in packages:
-                    for pkg_name in self.pkg_names:
-                        if pkg_name in item['URL']:
-                            basename = os.path.basename(item['URL'])
-                            distribution = catalog['Products'][product]['Distributions']['English']  # Not used in this tool presently, but may in future.
-                            product_id = product
-                            metadataSMDurl = catalog['Products'][product]['ServerMetadataURL']
-                            metadataPKMurl = item['MetadataURL']
-                            metadata = self.processMetadata(smd_url=metadataSMDurl, pkm_url=metadataPKMurl)
-                            pkg_ver = metadata['pkg_version']
-                            long_pkg_ver = metadata['long_pkg_version']
-                            pkg_id = metadata['pkg_identifier']
-                            pkg_title = metadata['pkg_title']
-                            # Change the destination filename so it's clear what version of macOS and what version of CL tools.
-                            pkg_download_name = os.path.join(self.destination, basename.replace('.pkg', '_macOS_{}-{}.pkg'.format(self.mac_os_ver, '.'.join(long_pkg_ver.split('.')[:3]))))
-
-                            # Test if combo already exists in dictionary and if so, version comparison test to make sure only latest version gets added
-                            if basename not in self.packages_to_process.keys():
-                                self.packages_to_process[basename] = {'distribution': distribution, 'product_id': product_id, 'pkg_title': pkg_title, 'pkg': basename, 'url': item['URL'], 'post_date': post_date, 'version': pkg_ver, 'long_version': long_pkg_ver, 'pkg_identifier': pkg_id, 'download_name': pkg_download_name}
-                            elif basename in self.packages_to_process.keys() and LooseVersion(long_pkg_ver) > LooseVersion(self.packages_to_process[basename]['long_version']):
-                                self.packages_to_process[basename] = {'distribution': distribution, 'product_id': product_id, 'pkg_title': pkg_title, 'pkg': basename, 'url': item['URL'], 'post_date': post_date, 'version': pkg_ver, 'long_version': long_pkg_ver, 'pkg_identifier': pkg_id, 'download_name': pkg_download_name}
-
-            # Remove the file now we're finished with it
-            try:
-                os.remove(destination_file)
-            except Exception:
-                pass
-        except Exception:
-            raise
+    def poll(self, member):
+        '''Processes a release's catalog and emits a new_version event for each package newer than last time. The first poll of'''
+        '''a release emits a single watching event with the versions it starts from.'''
+        member.processSUCatalog()
+        if self.versions[member.mac_os_ver] is None:
+            self.versions[member.mac_os_ver] = dict((pkg, package['long_version']) for pkg, package in member.packages_to_process.items())
+            self.emit('watching', mac_os_ver=member.mac_os_ver, versions=self.versions[member.mac_os_ver])
+            return
+
+        known = self.versions[member.mac_os_ver]
+        for pkg, package in sorted(member.packages_to_process.items()):
+            # A package pulled from the catalog keeps the newest version seen, so it coming back isn't reported as new
+            if pkg in known and LooseVersion(package['long_version']) <= LooseVersion(known[pkg]):
+                continue
+            if self.prestage:
+                member.downloadPkg(package)
+            self.emit('new_version', mac_os_ver=member.mac_os_ver, pkg=pkg, product_id=package['product_id'], pkg_title=package['pkg_title'], pkg_identifier=package['pkg_identifier'],
+                      long_version=package['long_version'], previous_version=known.get(pkg), post_date=package['post_date'], url=package['url'],
+                      download_name=package['download_name'] if self.prestage else None)
+            # Only recorded once reported, so a failed download is tried again and reported on the next poll
+            known[pkg] = package['long_version']
+
+    def mainProcessor(self):
+        # Stopped the same way as an interrupt, so the metrics are still written
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-    def processMetadata(self, smd_url, pkm_url):
-        smd_destination_file = os.path.join(self.destination, os.path.basename(smd_url))
-        pkm_destination_file = os.path.join(self.destination, os.path.basename(pkm_url))
+        due = dict((member.mac_os_ver, time.time()) for member in self.group.members)
+        failures = dict((member.mac_os_ver, 0) for member in self.group.members)
         try:
-            os.remove(smd_destination_file)
-            os.remove(pkm_destination_file)
-        except Exception:
+            while True:
+                member = min(self.group.members, key=lambda member: due[member.mac_os_ver])
+                time.sleep(max(0, due[member.mac_os_ver] - time.time()))
+                try:
+                    with self.metrics.phase('poll'):
+                        self.poll(member)
+                    failures[member.mac_os_ver] = 0
+                    delay = self.interval
+                except Exception as e:
+                    failures[member.mac_os_ver] += 1
+                    delay = min(self.interval, self.min_backoff * 2 ** (failures[member.mac_os_ver] - 1))
+                    self.emit('poll_failed', mac_os_ver=member.mac_os_ver, error=str(e), failures=failures[member.mac_os_ver], retry_in=delay)
+                due[member.mac_os_ver] = time.time() + delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+                if self.metrics_out:
+                    self.metrics.save(self.metrics_out)
+        except KeyboardInterrupt:
             pass
-        try:
-            self.curl(smd_url, smd_destination_file, quiet=True)
-            self.curl(pkm_url, pkm_destination_file, quiet=True)
-            meta_tree = ET.parse(pkm_destination_file)
-            meta_root = meta_tree.getroot()
-            long_pkg_version = meta_root.attrib['version']
-            pkg_identifier = meta_root.attrib['identifier']
-            metadata = plistlib.readPlist(smd_destination_file)
-            pkg_version = metadata['CFBundleShortVersionString']
-            pkg_title = metadata['localization']['English']['title']
-
-            # Remove the file now we're finished with it
-            try:
-                os.remove(smd_destination_file)
-                os.remove(pkm_destination_file)
-            except Exception:
-                pass
-
-            return {'long_pkg_version': long_pkg_version, 'pkg_version': pkg_version, 'pkg_identifier': pkg_identifier, 'pkg_title': pkg_title}
-        except Exception:
-            raise
 
-    def curl(self, input_file, output_file, quiet=False):
-        cmd = ['/usr/bin/curl']
 
-        # quiet or progress bar depending on XcodeTools() attributes
-        if self.quiet or quiet:
-            cmd.extend(['--silent'])
+class XcodeCLIQuery():
+    '''Answers list, search and show from the catalog index kept by the other commands, without fetching anything.'''
+    def __init__(self, command, query=False, cache_dir=False, index_file=False, mac_os_vers=False):
+        '''Initialise class XcodeCLIQuery() for command, one of list, search or show.'''
+        '''Attributes:'''
+        '''    query = text to search for, or the product ID to show'''
+        '''    cache_dir = override the folder path the catalog index is kept in'''
+        '''    index_file = override the file path of the catalog index'''
+        '''    mac_os_vers = only answer for these macOS releases'''
+        if index_file:
+            self.index = CatalogIndex(os.path.expandvars(os.path.expanduser(index_file)))
         else:
-            cmd.extend(['--progress-bar'])
+            self.index = CatalogIndex(os.path.join(os.path.expandvars(os.path.expanduser(cache_dir or XcodeCLI.default_cache_dir)), 'index.sqlite'))
+        self.command = command
+        self.query = query
+        if mac_os_vers and 'all' not in mac_os_vers:
+            self.mac_os_vers = mac_os_vers
+        else:
+            self.mac_os_vers = None
 
-        # Try and auto resume from offset if file exists and server supports it, also create destination directory if it doesn't exist
-        if not os.path.exists(output_file):  # Rudimentary block on downloading a file if it already exists. SU servers don't seem to support resuming downloads from an offset.
-            cmd.extend(['-L', '-C', '-', input_file, '--create-dirs', '-o', output_file])
-            subprocess.check_call(cmd)
+    def listProducts(self):
+        '''Prints each indexed product for each release, newest first.'''
+        products = OrderedDict()
+        for row in self.index.query(mac_os_vers=self.mac_os_vers):
+            products.setdefault((row['mac_os_ver'], row['product_id']), []).append(row)
+        for (mac_os_ver, product_id), rows in products.items():
+            print '{:<6} {:<10} {}  {:<45} {}'.format(mac_os_ver, product_id, rows[0]['post_date'], rows[0]['pkg_title'] or '-', ', '.join(sorted(set(row['pkg'] for row in rows))))
+        return bool(products)
 
-    def installPkg(self, package):
-        cmd = ['/usr/sbin/installer', '-pkg', package]
-        if self.allow_untrusted_pkg_install:
-            cmd.extend(['--allowUntrusted'])
-        cmd.extend(['-target', self.install_target])
+    def search(self):
+        '''Prints each indexed package whose name, title, identifier, version or product ID contains the query.'''
+        term = '%{}%'.format(self.query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+        rows = self.index.query(' OR '.join("{} LIKE ? ESCAPE '\\'".format(column) for column in ['pkg', 'pkg_title', 'pkg_identifier', 'long_version', 'product_id']), (term,) * 5, mac_os_vers=self.mac_os_vers)
+        for row in rows:
+            print '{:<6} {:<10} {}  {:<40} {:<24} {:>12}'.format(row['mac_os_ver'], row['product_id'], row['post_date'], row['pkg'], row['long_version'] or '-', row['size'] if row['size'] is not None else '-')
+        return bool(rows)
 
-        if not self.dry_run:
-            if LooseVersion(self.system_mac_os_ver) == LooseVersion(self.mac_os_ver):
-                print '{} {}'.format(self.install_msg, package)
-                (result, error) = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-
-                if 'successful' in result:
-                    result_msg = 'install successful'
-                if 'upgrade' in result:
-                    result_msg = 'upgrade successful'
-                if error or any(x in result.lower() for x in ['fail', 'failed']):
-                    result_msg = 'install/upgrade failed, see /var/log/install.log'
-
-                print '{} {}'.format(package, result_msg)
-            else:
-                print 'Not a good idea to try and install macOS {} CL tools on macOS {}'.format(self.mac_os_ver, self.system_mac_os_ver)
-                print 'Downloaded files can be found in {}'.format(self.destination)
-                sys.exit(1)
+    def show(self):
+        '''Prints everything indexed about a product.'''
+        rows = self.index.query('product_id = ?', (self.query,), mac_os_vers=self.mac_os_vers)
+        if not rows:
+            return False
+        print '{} - {} (version {}) posted {}'.format(rows[0]['product_id'], rows[0]['pkg_title'] or '-', rows[0]['version'] or '-', rows[0]['post_date'])
+        print 'macOS releases: {}'.format(', '.join(sorted(set(row['mac_os_ver'] for row in rows), key=LooseVersion)))
+        shown = set()
+        for row in rows:
+            if row['url'] in shown:
+                continue
+            shown.add(row['url'])
+            print '    {}'.format(row['pkg'])
+            for label, column in [('URL', 'url'), ('Size', 'size'), ('Digest', 'digest'), ('Identifier', 'pkg_identifier'), ('Version', 'long_version'), ('Metadata', 'pkm_url')]:
+                print '        {:<11} {}'.format(label + ':', row[column] if row[column] is not None else '-')
+        return True
 
     def mainProcessor(self):
-        if self.install and os.getuid() is not 0:
-            print 'Must be root to install packages.'
+        if not os.path.exists(self.index.index_file):
+            print 'The catalog index {} doesn\'t exist yet, it is filled in as catalogs are fetched by download, serve or watch'.format(self.index.index_file)
+            sys.exit(1)
+        found = {'list': self.listProducts, 'search': self.search, 'show': self.show}[self.command]()
+        if not found:
+            print 'Nothing in the catalog index matches'
             sys.exit(1)
 
-        self.processSUCatalog()
-
-        # Note, not all catalogs contain the downloads once GM's are released
-        if not self.packages_to_process:
-            print 'No Command Line Tool downloads found'
-            sys.exit(0)
-
-        # There are packages that remove older SDK's, these may need to be installed first
-        remove_pkgs = [pkg for pkg in self.packages_to_process.keys() if 'Remove' in pkg]
-        if remove_pkgs:
-            remove_pkgs.sort()
-        for pkg in self.packages_to_process:
-            product_id = self.packages_to_process[pkg]['product_id']
-            title = self.packages_to_process[pkg]['pkg_title']
-            pkg_url = self.packages_to_process[pkg]['url']
-            download_file = self.packages_to_process[pkg]['download_name']
-            version = self.packages_to_process[pkg]['version']
-            date = self.packages_to_process[pkg]['post_date']
-            if not self.quiet and not os.path.exists(download_file):
-                print '{} {} - {} (version {} released {}) to {}'.format(self.download_msg, product_id, title, version, date, download_file)
-            if not self.dry_run:
-                self.curl(input_file=pkg_url, output_file=download_file)
 
-        if self.install:
-            # It appears these need to be installed first.
-            for pkg in remove_pkgs:
-                try:
-                    if not self.dry_run:
-                        self.installPkg(self.packages_to_process[pkg]['download_name'])
-                except Exception:
-                    raise
+def byteRate(value):
+    '''Returns a rate given as bytes/sec, optionally with a K, M or G suffix, as a number of bytes/sec. For use as an argparse type.'''
+    match = re.match(r'^(\d+(?:\.\d+)?)([KMG]?)$', value.strip().upper())
+    if not match or not float(match.group(1)):
+        raise argparse.ArgumentTypeError('{} is not a rate in bytes/sec, such as 500K or 2M'.format(value))
+    return int(float(match.group(1)) * 1024 ** ' KMG'.index(match.group(2) or ' '))
 
-            for pkg in self.packages_to_process:
-                # Only install if pkg is not in remove_pkgs
-                if pkg not in remove_pkgs:
-                    print '{} {}'.format(self.install_msg, self.packages_to_process[pkg]['download_name'])
-                    if not self.dry_run:
-                        try:
-                            self.installPkg(self.packages_to_process[pkg]['download_name'])
-                        except Exception:
-                            raise
-            try:
-                if not self.quiet:
-                    print '{} {}'.format(self.cleanup_msg, self.destination)
-                shutil.rmtree(self.destination)
-            except Exception:
-                raise
+
+def positiveCount(value):
+    '''Returns a whole number of 1 or more, such as a number of connections. For use as an argparse type.'''
+    if not re.match(r'^\s*\d+\s*$', value) or not int(value):
+        raise argparse.ArgumentTypeError('{} is not a whole number of 1 or more'.format(value))
+    return int(value)
 
 
 def main():
@@ -302,9 +2233,27 @@ def main():
         def _get_default_metavar_for_optional(self, action):
             return action.dest.upper()
 
+        def _get_default_metavar_for_positional(self, action):
+            return action.dest
+
     parser = argparse.ArgumentParser(formatter_class=SaneUsageFormat)
     exclude = parser.add_mutually_exclusive_group()
 
+    parser.add_argument(
+        'command',
+        nargs='?',
+        default='download',
+        choices=['download', 'list', 'search', 'serve', 'show', 'watch'],
+        help='download (default) the tools, serve them to other clients as a local mirror, or watch the catalogs for new versions. list, search and show answer from the catalog index of what has been fetched before.',
+    )
+
+    parser.add_argument(
+        'query',
+        nargs='?',
+        metavar='query',
+        help='Text to search for, or the product ID to show.',
+    )
+
     parser.add_argument(
         '--allowUntrusted',
         action='store_true',
@@ -313,6 +2262,36 @@ def main():
         required=False
     )
 
+    parser.add_argument(
+        '--base-url',
+        type=str,
+        nargs=1,
+        dest='base_url',
+        metavar='<url>',
+        help='Send every request to this scheme and host instead of the one in the URL, for example a local mirror or test server.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--cache-dir',
+        type=str,
+        nargs=1,
+        dest='cache_dir',
+        metavar='<cache path>',
+        help='Specify alternative folder path for catalogs to be cached in between runs. Defaults to ~/Library/Caches/xcodetools.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--cache-max-age',
+        type=int,
+        nargs=1,
+        dest='cache_max_age',
+        metavar='<seconds>',
+        help='Use a cached catalog without checking with the server if it was last checked less than this many seconds ago. Defaults to 0, always check.',
+        required=False
+    )
+
     parser.add_argument(
         '-c', '--catalog',
         type=str,
@@ -323,6 +2302,16 @@ def main():
         help='Specify a non standard softare update catalog (such as beta/customer/developer seed). Note, this is pretty much pointless as the CLTools and SDK packages are pretty much the same files regardless of which program catalog you access.',
     )
 
+    parser.add_argument(
+        '--connections',
+        type=positiveCount,
+        nargs=1,
+        dest='connections',
+        metavar='<connections>',
+        help='Maximum number of concurrent connections used to download each package, if the server supports byte ranges. Defaults to 4.',
+        required=False
+    )
+
     parser.add_argument(
         '-d', '--destination',
         type=str,
@@ -333,6 +2322,24 @@ def main():
         required=False
     )
 
+    parser.add_argument(
+        '--events-out',
+        type=str,
+        nargs=1,
+        dest='events_out',
+        metavar='<events file>',
+        help='File watch appends each event to as a line of JSON, as well as writing it to stdout.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--changes-only',
+        action='store_true',
+        dest='changes_only',
+        help='Only print the products that are new, changed or removed since the last --changes-only run, without resolving or downloading anything. Tracked separately from the products --incremental has downloaded. With -q, nothing else is printed.',
+        required=False,
+    )
+
     exclude.add_argument(
         '-n', '--dry-run',
         action='store_true',
@@ -341,6 +2348,24 @@ def main():
         required=False,
     )
 
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        dest='incremental',
+        help='Only resolve and download products that are new or changed since the last run.',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--index-file',
+        type=str,
+        nargs=1,
+        dest='index_file',
+        metavar='<index path>',
+        help='Specify alternative file path for the catalog index used by list, search and show. Defaults to index.sqlite in the cache folder.',
+        required=False
+    )
+
     parser.add_argument(
         '-i', '--install',
         action='store_true',
@@ -359,12 +2384,166 @@ def main():
     )
 
     parser.add_argument(
-        '--mac-os-ver',
+        '--installer',
+        type=str,
+        nargs=1,
+        dest='installer',
+        metavar='<installer path>',
+        help='Specify alternative installer command, called with the same arguments as /usr/sbin/installer. Root and macOS release checks only apply to /usr/sbin/installer.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--interval',
+        type=int,
+        nargs=1,
+        dest='interval',
+        metavar='<seconds>',
+        help='Time between polls of each catalog in watch mode, varied by up to 10%% either way. Defaults to 3600.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--listen',
+        type=str,
         nargs=1,
+        dest='listen',
+        metavar='<host:port>',
+        help='Address for serve to listen on. Defaults to 0.0.0.0:8088.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--mac-os-ver',
+        nargs='+',
         dest='mac_os_versions',
         metavar='<os version>',
-        choices=['10.9', '10.10', '10.11', '10.12', '10.13', '10.14'],
-        help='Specify alternative macOS release to download tools for. If not supplied, defaults to version of macOS installed on client.',
+        choices=XcodeCLI.supported_os_versions + ['all'],
+        help='Specify alternative macOS release(s) to download tools for, or \'all\' for every supported release. If not supplied, defaults to version of macOS installed on client.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--max-host-rate',
+        type=byteRate,
+        nargs=1,
+        dest='max_host_rate',
+        metavar='<bytes/sec>',
+        help='Maximum rate to fetch from any one host, in bytes/sec or with a K, M or G suffix. Defaults to no limit.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--max-rate',
+        type=byteRate,
+        nargs=1,
+        dest='max_rate',
+        metavar='<bytes/sec>',
+        help='Maximum rate to fetch at across every transfer, in bytes/sec or with a K, M or G suffix. Defaults to no limit.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--max-transfers',
+        type=positiveCount,
+        nargs=1,
+        dest='max_transfers',
+        metavar='<transfers>',
+        help='Maximum number of catalog, metadata and package transfers to have open at once. Catalogs and metadata go first, then Remove packages, CLTools and SDKs. Defaults to 8.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--max-workers',
+        type=positiveCount,
+        nargs=1,
+        dest='max_workers',
+        metavar='<workers>',
+        help='Maximum number of metadata requests to make concurrently. Defaults to 8.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--mirror-dir',
+        type=str,
+        nargs=1,
+        dest='mirror_dir',
+        metavar='<mirror path>',
+        help='Specify alternative folder path for serve to keep mirrored files in. Defaults to a mirror folder in the cache folder.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--mirror-url',
+        type=str,
+        nargs=1,
+        dest='mirror_url',
+        metavar='<url>',
+        help='URL clients reach the mirror at, used in the catalogs serve rewrites. Defaults to http://<this host>:<port>.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        dest='no_cache',
+        help='Download the catalog and package metadata in full, ignoring and not updating any cached copy.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--metrics-out',
+        type=str,
+        nargs=1,
+        dest='metrics_out',
+        metavar='<metrics file>',
+        help='Write the time spent in each phase, every HTTP fetch, retries and cache hits to this file when the run finishes. A Prometheus textfile if it ends in .prom, otherwise JSON.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--metadata-cache-size',
+        type=int,
+        nargs=1,
+        dest='metadata_cache_size',
+        metavar='<entries>',
+        help='Maximum number of package metadata entries to keep cached, least recently used are removed first. Defaults to 1024.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--prestage',
+        action='store_true',
+        dest='prestage',
+        help='Download new packages as soon as watch sees them, ready in the destination folder.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--profile',
+        type=str,
+        nargs=1,
+        dest='profile',
+        metavar='<profile file>',
+        help='Profile the run with cProfile and write the stats to this file, for use with pstats. Only the main thread is profiled.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--receipts-dir',
+        type=str,
+        nargs=1,
+        dest='receipts_dir',
+        metavar='<receipts path>',
+        help='Specify alternative folder of installed package receipts used to skip packages that are already up to date. Defaults to var/db/receipts on the install target.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--reinstall',
+        action='store_true',
+        dest='reinstall',
+        help='Install packages even if the receipts show the same or a newer version is already installed.',
         required=False
     )
 
@@ -372,7 +2551,48 @@ def main():
         '-q', '--quiet',
         action='store_true',
         dest='quiet_output',
-        help='Suppress all stdout output.',
+        help='Suppress all stdout output, except the changes printed by --changes-only.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--store-dir',
+        type=str,
+        nargs=1,
+        dest='store_dir',
+        metavar='<store path>',
+        help='Specify alternative folder path for downloaded packages to be kept in between runs. Download names are hardlinks into it. Defaults to a packages folder in the cache folder.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--store-quota',
+        type=int,
+        nargs=1,
+        dest='store_quota',
+        metavar='<megabytes>',
+        help='Maximum size of the package store, least recently used packages are removed first. Defaults to 10240.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--timeout',
+        type=int,
+        nargs=1,
+        dest='timeout',
+        metavar='<seconds>',
+        help='Maximum time in seconds to allow for each metadata request. Defaults to 30.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--transport',
+        type=str,
+        nargs=1,
+        dest='transport',
+        metavar='<transport>',
+        choices=['http', 'curl'],
+        help='Make requests in process with pooled connections (http), or by running /usr/bin/curl for each one (curl). Defaults to http.',
         required=False
     )
 
@@ -383,23 +2603,189 @@ def main():
     else:
         alt_catalog = False
 
+    if args.base_url and len(args.base_url) is 1:
+        base_url = args.base_url[0]
+    else:
+        base_url = False
+
+    if args.cache_dir and len(args.cache_dir) is 1:
+        cache_dir = args.cache_dir[0]
+    else:
+        cache_dir = False
+
+    if args.cache_max_age and len(args.cache_max_age) is 1:
+        cache_max_age = args.cache_max_age[0]
+    else:
+        cache_max_age = False
+
+    if args.connections and len(args.connections) is 1:
+        connections = args.connections[0]
+    else:
+        connections = False
+
     if args.download_destination and len(args.download_destination) is 1:
         download_dest = args.download_destination[0]
     else:
         download_dest = False
 
+    if args.events_out and len(args.events_out) is 1:
+        events_out = args.events_out[0]
+    else:
+        events_out = False
+
+    if args.index_file and len(args.index_file) is 1:
+        index_file = args.index_file[0]
+    else:
+        index_file = False
+
     if args.install_target and len(args.install_target) is 1:
         target = args.install_target[0]
     else:
         target = False
 
-    if args.mac_os_versions and len(args.mac_os_versions) is 1:
-        mac_vers = args.mac_os_versions[0]
+    if args.installer and len(args.installer) is 1:
+        installer = args.installer[0]
+    else:
+        installer = False
+
+    if args.interval and len(args.interval) is 1:
+        interval = args.interval[0]
+    else:
+        interval = False
+
+    if args.listen and len(args.listen) is 1:
+        listen = args.listen[0]
+    else:
+        listen = False
+
+    if args.mac_os_versions:
+        mac_vers = args.mac_os_versions
     else:
         mac_vers = False
 
-    xcode = XcodeCLI(allow_untrusted_pkg_install=args.allow_untrusted, catalog=alt_catalog, destination=download_dest, dry_run=args.dry_run, install=args.install_packages, install_target=target, mac_os_ver=mac_vers, quiet=args.quiet_output)
-    xcode.mainProcessor()
+    # Installing only makes sense for the release of macOS the tools are being installed on
+    if args.install_packages and mac_vers and (len(mac_vers) > 1 or 'all' in mac_vers):
+        parser.error('-i, --install can only be used with a single --mac-os-ver release.')
+
+    if args.command in ['search', 'show'] and not args.query:
+        parser.error('{} needs a query.'.format(args.command))
+
+    if args.command not in ['search', 'show'] and args.query:
+        parser.error('Only search and show take a query.')
+
+    # Nothing is downloaded with --changes-only, so there is nothing for a dry run to hold back
+    if args.changes_only and args.dry_run:
+        parser.error('--changes-only can\'t be used with -n, --dry-run.')
+
+    if args.command in ['serve', 'watch'] and (args.install_packages or args.dry_run or args.changes_only):
+        parser.error('{} can\'t be used with -i, --install, -n, --dry-run or --changes-only.'.format(args.command))
+
+    if args.max_host_rate and len(args.max_host_rate) is 1:
+        max_host_rate = args.max_host_rate[0]
+    else:
+        max_host_rate = False
+
+    if args.max_rate and len(args.max_rate) is 1:
+        max_rate = args.max_rate[0]
+    else:
+        max_rate = False
+
+    if args.max_transfers and len(args.max_transfers) is 1:
+        max_transfers = args.max_transfers[0]
+    else:
+        max_transfers = False
+
+    if args.max_workers and len(args.max_workers) is 1:
+        max_workers = args.max_workers[0]
+    else:
+        max_workers = False
+
+    if args.metadata_cache_size and len(args.metadata_cache_size) is 1:
+        metadata_cache_size = args.metadata_cache_size[0]
+    else:
+        metadata_cache_size = False
+
+    if args.metrics_out and len(args.metrics_out) is 1:
+        metrics_out = args.metrics_out[0]
+    else:
+        metrics_out = False
+
+    if args.mirror_dir and len(args.mirror_dir) is 1:
+        mirror_dir = args.mirror_dir[0]
+    else:
+        mirror_dir = False
+
+    if args.mirror_url and len(args.mirror_url) is 1:
+        mirror_url = args.mirror_url[0]
+    else:
+        mirror_url = False
+
+    if args.profile and len(args.profile) is 1:
+        profile = args.profile[0]
+    else:
+        profile = False
+
+    if args.receipts_dir and len(args.receipts_dir) is 1:
+        receipts_dir = args.receipts_dir[0]
+    else:
+        receipts_dir = False
+
+    if args.store_dir and len(args.store_dir) is 1:
+        store_dir = args.store_dir[0]
+    else:
+        store_dir = False
+
+    if args.store_quota and len(args.store_quota) is 1:
+        store_quota = args.store_quota[0]
+    else:
+        store_quota = False
+
+    if args.timeout and len(args.timeout) is 1:
+        timeout = args.timeout[0]
+    else:
+        timeout = False
+
+    if args.transport and len(args.transport) is 1:
+        transport = args.transport[0]
+    else:
+        transport = False
+
+    options = dict(allow_untrusted_pkg_install=args.allow_untrusted, base_url=base_url, cache_dir=cache_dir, cache_max_age=cache_max_age, catalog=alt_catalog, changes_only=args.changes_only, connections=connections, destination=download_dest, dry_run=args.dry_run, incremental=args.incremental, index_file=index_file, install=args.install_packages, install_target=target, installer=installer, max_host_rate=max_host_rate, max_rate=max_rate, max_transfers=max_transfers, max_workers=max_workers, metadata_cache_size=metadata_cache_size, no_cache=args.no_cache, quiet=args.quiet_output, receipts_dir=receipts_dir, reinstall=args.reinstall, store_dir=store_dir, store_quota=store_quota, timeout=timeout, transport=transport)
+    if args.command in ['list', 'search', 'show']:
+        xcode = XcodeCLIQuery(args.command, query=args.query, cache_dir=cache_dir, index_file=index_file, mac_os_vers=mac_vers)
+        xcode.mainProcessor()
+        return
+
+    if args.command == 'serve':
+        # A mirror serves every supported release unless told otherwise
+        xcode = XcodeCLIMirror(mac_os_vers=mac_vers or ['all'], listen=listen, mirror_dir=mirror_dir, mirror_url=mirror_url, **options)
+    elif args.command == 'watch':
+        # Watches every supported release unless told otherwise, the same as a mirror
+        xcode = XcodeCLIWatcher(mac_os_vers=mac_vers or ['all'], events_out=events_out, interval=interval, metrics_out=metrics_out, prestage=args.prestage, **options)
+    elif mac_vers and (len(mac_vers) > 1 or 'all' in mac_vers):
+        xcode = XcodeCLIGroup(mac_os_vers=mac_vers, **options)
+    else:
+        xcode = XcodeCLI(mac_os_ver=mac_vers and mac_vers[0], **options)
+
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        try:
+            xcode.mainProcessor()
+        finally:
+            # Also written when the run stops early, such as when there is nothing to download
+            if profile:
+                profiler.disable()
+                profiler.dump_stats(profile)
+            if metrics_out:
+                xcode.metrics.save(metrics_out)
+    except KeyboardInterrupt:
+        sys.stderr.write('\nInterrupted, partial downloads are resumed by the next run\n')
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Transfers still running in other threads are abandoned, exiting normally would wait on them or have them fail noisily
+        os._exit(130)
 
 
 if __name__ == '__main__':
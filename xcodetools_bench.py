@@ -0,0 +1,277 @@
+#!/usr/bin/python
+
+'''Benchmarks xcodetools against a synthetic software update catalog served from a local stand-in server, so performance can be
+measured as catalogs grow without touching swscan.apple.com. Each phase is run in its own process and reported with its wall time,
+the number of requests and bytes the server handled, and the peak RSS of the process.'''
+
+import argparse  # NOQA
+import gzip  # NOQA
+import hashlib  # NOQA
+import os  # NOQA
+import plistlib  # NOQA
+import shutil  # NOQA
+import sys  # NOQA
+import tempfile  # NOQA
+import threading  # NOQA
+import time  # NOQA
+import traceback  # NOQA
+
+import xcodetools  # NOQA
+
+from datetime import datetime  # NOQA
+
+
+class BenchRequestHandler(xcodetools.MirrorRequestHandler):
+    '''Serves the synthetic site like the mirror does, after the configured latency and no faster than the configured bandwidth.'''
+    def do_GET(self, head=False):
+        self.server.count(requests=1)
+        time.sleep(self.server.latency)
+        xcodetools.MirrorRequestHandler.do_GET(self, head=head)
+
+    def sendBody(self, served_file, offset, count):
+        sent = 0
+        while sent < count:
+            chunk = min(self.server.chunk_size, count - sent) if self.server.bandwidth else count - sent
+            self.server.throttle(chunk)
+            written = xcodetools.sendFile(self.connection, served_file, offset + sent, chunk)
+            self.server.count(transferred=written)
+            if not written:
+                break
+            sent += written
+
+
+class BenchServer(xcodetools.MirrorServer):
+    '''Local stand-in for the software update servers. Bandwidth is shared by every connection, like a single link would be.'''
+    chunk_size = 65536
+
+    def __init__(self, server_address, site_dir, latency=0, bandwidth=0):
+        xcodetools.MirrorServer.__init__(self, server_address, site_dir, quiet=True)
+        self.RequestHandlerClass = BenchRequestHandler
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.available_at = 0
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests, self.transferred = 0, 0
+
+    def count(self, requests=0, transferred=0):
+        with self.lock:
+            self.requests += requests
+            self.transferred += transferred
+
+    def throttle(self, size):
+        '''Waits until size more bytes can be sent without going over the bandwidth.'''
+        if not self.bandwidth:
+            return
+        with self.lock:
+            start = max(self.available_at, time.time())
+            self.available_at = start + float(size) / self.bandwidth
+        time.sleep(max(0, self.available_at - time.time()))
+
+
+def generateSite(site_dir, mac_os_vers, products=1000, packages=4, matching=10, payload_size=1048576):
+    '''Writes a synthetic site to site_dir: a gzipped sucatalog per release with products products of packages packages each, of which'''
+    '''matching products hold CLTools packages with their SMD/PKM metadata and payloads. The other products are only in the catalog as'''
+    '''nothing fetches them. Returns the number of bytes written.'''
+    written = 0
+    spacing = max(1, products // max(1, matching))
+    cltools_names = ['RemoveCLTools_OldSDK.pkg', 'CLTools_Executables.pkg', 'CLTools_SDK_macOS1014.pkg']
+    block = hashlib.sha256('xcodetools').digest() * 32768  # 1 MiB of filler for payloads
+
+    def writeFile(path, data):
+        path = os.path.join(site_dir, path.lstrip('/'))
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as site_file:
+            site_file.write(data)
+        return len(data)
+
+    catalog_products = {}
+    for number in range(products):
+        product_id = '091-{:05d}'.format(number)
+        product_dir = '/content/downloads/{:02d}/{:02d}/{}'.format(number // 100, number % 100, product_id)
+        is_matching = number % spacing == 0 and number // spacing < matching
+        names = cltools_names[:packages] if is_matching else []
+        names = names + ['Package{}.pkg'.format(count) for count in range(packages - len(names))]
+
+        product = {
+            'Distributions': {'English': 'https://swdist.apple.com{}/{}.English.dist'.format(product_dir, product_id)},
+            'Packages': [],
+            'PostDate': datetime(2018, 1, 1 + number % 28, number % 24),
+            'ServerMetadataURL': 'https://swcdn.apple.com{}/{}.smd'.format(product_dir, product_id),
+        }
+        for name in names:
+            url = '{}/{}'.format(product_dir, name)
+            package = {'URL': 'https://swcdn.apple.com{}'.format(url), 'MetadataURL': 'https://swcdn.apple.com{}'.format(url.replace('.pkg', '.pkm'))}
+            if is_matching and 'CLTools' in name:
+                # Each payload is unique so every one has its own digest
+                payload = (product_id + name + block * (payload_size // len(block) + 1))[:payload_size]
+                written += writeFile(url, payload)
+                written += writeFile(url.replace('.pkg', '.pkm'), '<?xml version="1.0" encoding="UTF-8"?>\n<pkg-info identifier="com.apple.pkg.{}" version="10.2.0.0.1.{}" />\n'.format(name[:-4], 1500000000 + number))
+                package.update({'Size': len(payload), 'Digest': hashlib.sha1(payload).hexdigest()})
+            else:
+                package.update({'Size': payload_size, 'Digest': hashlib.sha1(url).hexdigest()})
+            product['Packages'].append(package)
+        if is_matching:
+            written += writeFile(product['ServerMetadataURL'][len('https://swcdn.apple.com'):], plistlib.writePlistToString({'CFBundleShortVersionString': '10.{}'.format(number), 'localization': {'English': {'title': 'Command Line Tools (macOS) version 10.{}'.format(number)}}}))
+        catalog_products[product_id] = product
+
+    catalog = plistlib.writePlistToString({'CatalogVersion': 2, 'Products': catalog_products})
+    for mac_os_ver in mac_os_vers:
+        path = os.path.join(site_dir, 'content/catalogs/others/index-{}.merged-1.sucatalog.gz'.format(mac_os_ver))
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with gzip.open(path, 'wb') as sucatalog_file:
+            sucatalog_file.write(catalog)
+        written += os.path.getsize(path)
+    return written
+
+
+class Benchmark():
+    '''Runs each phase of xcodetools against a BenchServer() and collects its measurements.'''
+    phases = ['processSUCatalog', 'processSUCatalog (cached)', 'resolveMetadata', 'download', 'mainProcessor']
+
+    def __init__(self, server, work_dir, mac_os_ver, **kwargs):
+        '''Any keyword arguments are passed on to XcodeCLI().'''
+        self.server = server
+        self.work_dir = work_dir
+        self.mac_os_ver = mac_os_ver
+        self.options = kwargs
+        self.base_url = 'http://{}:{}'.format(*server.server_address)
+
+    def newXcodeCLI(self, name, **kwargs):
+        '''Returns an XcodeCLI() using the server and a cache and destination of its own, called name.'''
+        options = dict(self.options)
+        options.update(kwargs)
+        return xcodetools.XcodeCLI(base_url=self.base_url, cache_dir=os.path.join(self.work_dir, name, 'cache'), destination=os.path.join(self.work_dir, name, 'dest'), mac_os_ver=self.mac_os_ver, quiet=True, **options)
+
+    def setup(self, phase):
+        '''Returns the function that runs a phase, after doing whatever it needs done first that isn't part of the measurement.'''
+        if phase == 'processSUCatalog':
+            xcode = self.newXcodeCLI('cold', no_cache=True)
+            return xcode.processSUCatalog
+
+        if phase == 'processSUCatalog (cached)':
+            xcode = self.newXcodeCLI('cached')
+            xcode.processSUCatalog()
+            return xcode.processSUCatalog
+
+        if phase == 'resolveMetadata':
+            xcode = self.newXcodeCLI('metadata', no_cache=True)
+            xcode.processSUCatalog()
+            xcode.metadata_cache = xcodetools.MetadataCache()
+            return lambda: xcode.resolveMetadata(xcode.candidates)
+
+        if phase == 'download':
+            xcode = self.newXcodeCLI('download', no_cache=True)
+            xcode.processSUCatalog()
+            return lambda: [xcode.downloadPkg(package) for package in xcode.packages_to_process.values()]
+
+        if phase == 'mainProcessor':
+            xcode = self.newXcodeCLI('main')
+            return xcode.mainProcessor
+
+    def runPhase(self, phase):
+        '''Runs a phase in a child process so its peak RSS is its own. Returns a dictionary of measurements.'''
+        '''The child sets up the phase, says it is ready, then waits to be told to go so the server's counts only cover the phase.'''
+        ready_read, ready_write = os.pipe()
+        go_read, go_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                os.close(ready_read)
+                os.close(go_write)
+                run = self.setup(phase)
+                os.write(ready_write, 'r')
+                if not os.read(go_read, 1):
+                    os._exit(1)
+                run()
+            except SystemExit as e:
+                status = e.code or 0
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            os._exit(status)
+
+        os.close(ready_write)
+        os.close(go_read)
+        ready = os.read(ready_read, 1)
+        os.close(ready_read)
+        self.server.reset()
+        start = time.time()
+        if ready:
+            os.write(go_write, 'g')
+        os.close(go_write)
+        _, status, usage = os.wait4(pid, 0)
+        wall_time = time.time() - start
+
+        # Linux reports the peak RSS in kilobytes, macOS in bytes
+        peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        return {'phase': phase, 'ok': bool(ready) and status == 0, 'wall_time': wall_time, 'requests': self.server.requests, 'transferred': self.server.transferred, 'peak_rss': peak_rss}
+
+    def run(self, phases=None, repeat=1):
+        results = []
+        for phase in phases or self.phases:
+            for _ in range(repeat):
+                results.append(self.runPhase(phase))
+                shutil.rmtree(self.work_dir, ignore_errors=True)
+        return results
+
+
+def printResults(results):
+    print '{:<28} {:>10} {:>10} {:>14} {:>12}'.format('phase', 'wall (s)', 'requests', 'transferred', 'peak RSS')
+    for result in results:
+        print '{:<28} {:>10.3f} {:>10} {:>12.1f}MB {:>10.1f}MB{}'.format(result['phase'], result['wall_time'], result['requests'], result['transferred'] / 1048576.0, result['peak_rss'] / 1048576.0, '' if result['ok'] else '  FAILED')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--products', type=int, default=1000, metavar='<products>', help='Number of products in the synthetic catalog. Defaults to 1000.')
+    parser.add_argument('--packages', type=int, default=4, metavar='<packages>', help='Number of packages in each product. Defaults to 4.')
+    parser.add_argument('--matching', type=int, default=10, metavar='<products>', help='Number of products holding Command Line Tools packages. Defaults to 10.')
+    parser.add_argument('--payload-size', type=int, default=1048576, dest='payload_size', metavar='<bytes>', help='Size of each Command Line Tools package. Defaults to 1048576.')
+    parser.add_argument('--latency', type=float, default=0, metavar='<seconds>', help='Time the server waits before answering each request. Defaults to 0.')
+    parser.add_argument('--bandwidth', type=int, default=0, metavar='<bytes/sec>', help='Bandwidth shared by every connection to the server. Defaults to 0, unlimited.')
+    parser.add_argument('--phase', action='append', dest='phases', metavar='<phase>', choices=Benchmark.phases, help='Phase to run, may be given more than once. Defaults to every phase.')
+    parser.add_argument('--repeat', type=int, default=1, metavar='<count>', help='Number of times to run each phase. Defaults to 1.')
+    parser.add_argument('--site-dir', type=str, dest='site_dir', metavar='<site path>', help='Keep the synthetic site in this folder and reuse it if it is already there, rather than generating it in a temporary folder.')
+    parser.add_argument('--connections', type=int, metavar='<connections>', help='Passed on to xcodetools.')
+    parser.add_argument('--max-workers', type=int, dest='max_workers', metavar='<workers>', help='Passed on to xcodetools.')
+    parser.add_argument('--transport', type=str, choices=['http', 'curl'], metavar='<transport>', help='Passed on to xcodetools.')
+
+    args = parser.parse_args()
+    mac_os_ver = '10.14'
+
+    temp_dir = tempfile.mkdtemp(prefix='xcodetools_bench.')
+    try:
+        site_dir = args.site_dir or os.path.join(temp_dir, 'site')
+        if not os.path.exists(os.path.join(site_dir, 'content/catalogs/others/index-{}.merged-1.sucatalog.gz'.format(mac_os_ver))):
+            start = time.time()
+            written = generateSite(site_dir, [mac_os_ver], products=args.products, packages=args.packages, matching=args.matching, payload_size=args.payload_size)
+            print 'Generated {} products of {} packages ({:.1f}MB) in {:.1f}s'.format(args.products, args.packages, written / 1048576.0, time.time() - start)
+
+        server = BenchServer(('127.0.0.1', 0), site_dir, latency=args.latency, bandwidth=args.bandwidth)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        try:
+            benchmark = Benchmark(server, os.path.join(temp_dir, 'work'), mac_os_ver, connections=args.connections, max_workers=args.max_workers, transport=args.transport)
+            results = benchmark.run(phases=args.phases, repeat=args.repeat)
+        finally:
+            server.shutdown()
+            server.server_close()
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    printResults(results)
+    if not all(result['ok'] for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()